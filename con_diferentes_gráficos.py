@@ -80,6 +80,17 @@ def norm_code(code):
         digits = digits.zfill(4)
     return digits
 
+def semana_iso_str_from_ts(ts) -> str:
+    """Semana ISO 'YYYY-Www' (lunes-domingo); la misma etiqueta en demanda y desbordes."""
+    iso = ts.isocalendar()
+    return f"{int(iso[0])}-W{int(iso[1]):02d}"
+
+def semanas_iso(fechas):
+    """Etiquetas ISO para una columna de fechas, calculadas una vez por día distinto."""
+    dias = fechas.dt.normalize()
+    etiquetas = {d: semana_iso_str_from_ts(d) for d in dias.dropna().unique()}
+    return dias.map(etiquetas)
+
 # ------------------------------------------------------------
 # DETECTAR COLUMNA CLIENTE
 # ------------------------------------------------------------
@@ -242,7 +253,7 @@ def modo_C(df_agr, df_mat, capacidades, DG_code, MCH_code):
                     posible = cant_por_cap(centro, cap, r)
                     if posible <= 0:
                         fecha += timedelta(days=1)
-                        semana = fecha.strftime("%Y-%W")
+                        semana = semana_iso_str_from_ts(fecha)
                         continue
 
                     hprod = horas_nec(centro, posible, r)
@@ -274,7 +285,7 @@ def ejecutar_calculo(df_cap, df_mat, df_cli, df_dem, ajustes):
 
     df_dem = df_dem.copy()
     df_dem["Fecha_DT"] = pd.to_datetime(df_dem["Fecha de necesidad"])
-    df_dem["Semana_Label"] = df_dem["Fecha_DT"].dt.strftime("%Y-W%U")
+    df_dem["Semana_Label"] = semanas_iso(df_dem["Fecha_DT"])
 
     col_cli_dem = detectar_columna_cliente(df_dem)
     col_cli_cli = detectar_columna_cliente(df_cli)
@@ -484,7 +495,7 @@ with tab2:
         # Normalización fechas y semana
         df_dem = df_dem.copy()
         df_dem["Fecha_DT"] = pd.to_datetime(df_dem["Fecha de necesidad"])
-        df_dem["Semana_Label"] = df_dem["Fecha_DT"].dt.strftime("%Y-W%U")
+        df_dem["Semana_Label"] = semanas_iso(df_dem["Fecha_DT"])
 
         # Merge con maestros
         col_cli_dem = detectar_columna_cliente(df_dem)
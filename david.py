@@ -56,6 +56,42 @@ def guardar_archivo(archivo, nombre_seccion):
         return ruta_archivo
     return None
 
+def traer_columnas(df, maestro, claves, columnas):
+    """
+    Añade a df solo las columnas indicadas del maestro, buscando cada clave en un índice clave → fila.
+    Las filas repetidas idénticas se ignoran; si una clave tiene datos distintos se usa la primera
+    y se avisa con la lista de conflictos. Muestra el ancho y la memoria del resultado frente a
+    los de un merge con el maestro entero (estimados: bytes medios por fila del maestro).
+    """
+    columnas = [c for c in columnas if c in maestro.columns and c not in df.columns]
+    for c in claves:
+        # Como hacía merge: texto contra número no se cruza (daría todo vacío sin avisar)
+        if pd.api.types.is_numeric_dtype(df[c]) != pd.api.types.is_numeric_dtype(maestro[c]):
+            raise ValueError(f"La clave '{c}' tiene tipos distintos en la demanda ({df[c].dtype}) y en el maestro ({maestro[c].dtype}).")
+    # Lo que traería un merge con el maestro entero, para compararlo con el cruce proyectado
+    extra = [c for c in maestro.columns if c not in claves]
+    memoria_merge = df.memory_usage(deep=True, index=False).sum() + \
+        maestro[extra].memory_usage(deep=True, index=False).sum() / max(len(maestro), 1) * len(df)
+    maestro = maestro[claves + columnas]
+    repetidas = maestro.duplicated(claves, keep=False)
+    if repetidas.any():
+        distintas = maestro[repetidas].drop_duplicates()
+        conflictos = distintas[distintas.duplicated(claves, keep=False)].sort_values(claves, kind="stable")
+        if len(conflictos):
+            st.warning(f"⚠️ {conflictos[claves].drop_duplicates().shape[0]} claves ({', '.join(claves)}) con datos distintos en el maestro; se usa la primera fila de cada una.")
+            with st.expander("Ver conflictos"):
+                st.dataframe(conflictos, use_container_width=True)
+        maestro = maestro.drop_duplicates(claves)
+    indice = pd.MultiIndex.from_frame(maestro[claves]) if len(claves) > 1 else pd.Index(maestro[claves[0]])
+    buscadas = pd.MultiIndex.from_frame(df[claves]) if len(claves) > 1 else pd.Index(df[claves[0]])
+    traidas = maestro[columnas].reset_index(drop=True).reindex(indice.get_indexer(buscadas))
+    traidas.index = df.index
+    df = pd.concat([df, traidas], axis=1)
+    st.caption(f"Cruce por {', '.join(claves)}: {df.shape[1]} columnas, "
+               f"{df.memory_usage(deep=True, index=False).sum() / 1e6:.2f} MB "
+               f"(merge con el maestro entero: {df.shape[1] - len(columnas) + len(extra)} columnas, ~{memoria_merge / 1e6:.2f} MB)")
+    return df
+
 def procesar_logica_estable(df_dem, df_mat, df_cli, df_cap, ajustes_semanales):
     """Lógica optimizada del Programa 2"""
     lista_centros_disponibles = df_cap['Centro'].unique().tolist()
@@ -67,8 +103,14 @@ def procesar_logica_estable(df_dem, df_mat, df_cli, df_cap, ajustes_semanales):
     df_dem['Fecha_DT'] = pd.to_datetime(df_dem['Fecha de necesidad'])
     df_dem['Semana_Label'] = df_dem['Fecha_DT'].dt.strftime('%Y-W%U')
 
-    df = df_dem.merge(df_mat, on=['Material', 'Unidad'], how='left')
-    df = df.merge(df_cli, on='Cliente', how='left')
+    # Solo las columnas que usa la decisión y el cálculo de lotes (no descripciones ni direcciones)
+    df = traer_columnas(df_dem, df_mat, ['Material', 'Unidad'], [
+        'Tamaño lote mínimo', 'Tamaño lote máximo',
+        'Tiempo fabricación unidad DG', 'Tiempo fabricación unidad MCH',
+        'Coste fabricacion unidad DG', 'Coste fabricacion unidad MCH',
+        'Exclusico DG', 'Exclusivo MCH'
+    ])
+    df = traer_columnas(df, df_cli, ['Cliente'], [f'Distancia a {C1}', f'Distancia a {C2}'])
 
     def decidir_centro(r):
         if str(r.get('Exclusico DG')).strip().upper() == 'X': return C1
@@ -95,6 +137,9 @@ def procesar_logica_estable(df_dem, df_mat, df_cli, df_cap, ajustes_semanales):
         'Tiempo fabricación unidad MCH': 'first'
     }).reset_index()
 
+    # Fecha de fabricación en texto: una conversión por columna, no por propuesta
+    df_agrupado['Fecha_Fab'] = pd.to_datetime(df_agrupado['Fecha de necesidad']).dt.strftime('%Y%m%d')
+
     resultado_lotes = []
     cont = 1
     for _, fila in df_agrupado.iterrows():
@@ -111,7 +156,7 @@ def procesar_logica_estable(df_dem, df_mat, df_cli, df_cap, ajustes_semanales):
                 'Clase de orden': 'NORM',
                 'Cantidad a fabricar': cant_por_orden,
                 'Unidad': fila['Unidad'],
-                'Fecha de fabricación': pd.to_datetime(fila['Fecha de necesidad']).strftime('%Y%m%d'),
+                'Fecha de fabricación': fila['Fecha_Fab'],
                 'Semana': fila['Semana_Label'],
                 'Horas': cant_por_orden * t_fab
             })
@@ -34,31 +34,46 @@ os.makedirs(UPLOAD_DIR, exist_ok=True)
 # HISTORIAL EN LOCALSTORAGE
 # ============================================================
 
+# El historial se guarda como anillo de capacidad fija: cada evento va en su
+# propia clave (historial_min:0 … historial_min:N-1) con su número de orden y
+# los últimos timestamps por acción. Así cada evento es una sola escritura al
+# navegador y el tamaño total queda acotado; la cabeza y el resumen se sacan
+# del evento más reciente, buscado en los valores que LocalStorage ya leyó al
+# arrancar (sin viajes al navegador).
+HIST_CAPACIDAD = 200
+
+def _hueco_historial(i: int) -> str:
+    return f"{HIST_KEY}:{i % HIST_CAPACIDAD}"
+
+def _ultimo_evento():
+    """Evento del anillo con mayor número de orden (None si no hay ninguno)."""
+    eventos = (localS.getItem(_hueco_historial(i)) for i in range(HIST_CAPACIDAD))
+    validos = [e for e in eventos if isinstance(e, dict) and isinstance(e.get("n"), int)]
+    return max(validos, key=lambda e: e["n"], default=None)
+
 def log_mini(action: str):
-    """Guarda un evento en el localStorage del navegador."""
+    """Guarda un evento en su hueco del anillo de localStorage (una escritura)."""
     now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    data = localS.getItem(HIST_KEY)
-    if data is None:
-        data = []
-    data.append({"ts": now, "action": action})
-    localS.setItem(HIST_KEY, data)
+    # La lista antigua (versión sin anillo) crecía sin límite: se elimina una vez
+    if isinstance(localS.getItem(HIST_KEY), list):
+        localS.deleteItem(HIST_KEY, key="borrar_historial_antiguo")
+    ultimo = _ultimo_evento()
+    n = ultimo["n"] + 1 if ultimo else 0
+    ultimos = dict(ultimo.get("ultimos") or {}) if ultimo else {}
+    ultimos[action] = now
+    # Clave de componente única por escritura (evita IDs duplicados en un mismo run)
+    k = st.session_state.get("_escrituras_local", 0) + 1
+    st.session_state["_escrituras_local"] = k
+    localS.setItem(_hueco_historial(n), {"n": n, "ts": now, "action": action, "ultimos": ultimos},
+                   key=f"set_{HIST_KEY}_{k}")
 
 def last_status():
     """Devuelve últimos timestamps de cálculo inicial y replanificación."""
-    data = localS.getItem(HIST_KEY)
-    if not data:
+    ultimo = _ultimo_evento()
+    ultimos = ultimo.get("ultimos") if ultimo else None
+    if not isinstance(ultimos, dict):
         return None, None
-
-    ult_calc = None
-    ult_repl = None
-
-    for row in data:
-        if row["action"] == "calculo_inicial":
-            ult_calc = row["ts"]
-        if row["action"] == "replanificacion":
-            ult_repl = row["ts"]
-
-    return ult_calc, ult_repl
+    return ultimos.get("calculo_inicial"), ultimos.get("replanificacion")
 
 def list_generated_files():
     """Lista archivos Excel generados por la app."""
@@ -10,7 +10,20 @@ import os
 import sqlite3
 import json
 import uuid
-from datetime import datetime, timedelta
+import csv
+import re
+import hashlib
+import time
+import io
+import pickle
+import zipfile
+import threading
+import queue
+import atexit
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import date, datetime, timedelta
+from functools import lru_cache
+from openpyxl import Workbook, load_workbook
 
 # ------------------------------------------------------------
 # CONFIGURACIÓN DE PÁGINA
@@ -27,6 +40,9 @@ st.set_page_config(
 # ------------------------------------------------------------
 UPLOAD_DIR = "archivos_cargados"
 os.makedirs(UPLOAD_DIR, exist_ok=True)
+CSV_FILAS_BLOQUE = 200_000   # líneas por bloque al leer Demanda en CSV
+STAGING_FILAS_INSERT = 20_000   # filas por executemany en el modo en disco (SQLite)
+XLSX_FILAS_BLOQUE = 20_000      # filas por tramo de una Demanda xlsx en streaming (tuplas de Python: más caras que el CSV)
 LOG_DB = os.path.join(UPLOAD_DIR, "historial.db")
 
 def _get_conn():
@@ -51,6 +67,20 @@ def init_db():
                 result  TEXT    -- JSON con resultados/resúmenes
             )
         """)
+        # Instantánea de la tabla de propuestas de un cálculo (npz por columnas), por fila de logs
+        c.execute("""
+            CREATE TABLE IF NOT EXISTS planes (
+                log_id INTEGER PRIMARY KEY,   -- logs.id
+                filas INTEGER,
+                bytes INTEGER,
+                datos BLOB NOT NULL
+            )
+        """)
+        # Filtros del historial en SQL; (columna, id) sirve también al orden por id de la paginación
+        c.execute("CREATE INDEX IF NOT EXISTS idx_logs_ts ON logs(ts)")
+        c.execute("CREATE INDEX IF NOT EXISTS idx_logs_user ON logs(user, id)")
+        c.execute("CREATE INDEX IF NOT EXISTS idx_logs_action ON logs(action, id)")
+        c.execute("CREATE INDEX IF NOT EXISTS idx_logs_session ON logs(session_id, id)")
         conn.commit()
 
 def _safe_json(data):
@@ -65,30 +95,207 @@ def get_session_id():
     return st.session_state["session_id"]
 
 def get_user():
-    u = st.session_state.get("username", None)
-    if not u:
-        u = os.getenv("USERNAME") or os.getenv("USER") or "anon"
-        st.session_state["username"] = u
-    return u
-
-def log_event(action, details=None, results=None):
-    """Registra una acción en el historial/auditoría."""
+    # "username" es la clave del campo de la barra lateral: no se puede escribir tras crearlo
+    return st.session_state.get("username") or os.getenv("USERNAME") or os.getenv("USER") or "anon"
+
+def plan_a_bytes(df):
+    """
+    Tabla de propuestas → npz comprimido por columnas. Las columnas de texto se guardan
+    como códigos + valores únicos; no se usa pickle (se lee con allow_pickle=False).
+    """
+    arrays, columnas = {}, []
+    for i, c in enumerate(df.columns):
+        s = df[c]
+        if isinstance(s.dtype, pd.CategoricalDtype):
+            tipo, valores = "cat", s.cat.categories
+            arrays[f"c{i}"] = s.cat.codes.to_numpy()
+        elif isinstance(s.dtype, np.dtype) and s.dtype.kind in "biuf":
+            tipo, valores = "num", None
+            arrays[f"c{i}"] = s.to_numpy()
+        elif isinstance(s.dtype, np.dtype) and s.dtype.kind == "M":
+            tipo, valores = "fecha", None
+            arrays[f"c{i}"] = s.to_numpy(dtype="datetime64[ns]").view("int64")
+        else:
+            tipo = "texto"
+            codigos, valores = pd.factorize(s)
+            arrays[f"c{i}"] = codigos.astype(np.int32)
+        if valores is not None:
+            u = np.asarray(list(valores))
+            arrays[f"u{i}"] = u.astype(str) if u.dtype.kind == "O" else u
+        columnas.append({"nombre": str(c), "tipo": tipo})
+    arrays["meta"] = np.array(json.dumps({"columnas": columnas}, ensure_ascii=False))
+    buf = io.BytesIO()
+    np.savez_compressed(buf, **arrays)
+    return buf.getvalue()
+
+def plan_de_bytes(datos):
+    """Inversa de plan_a_bytes."""
+    with np.load(io.BytesIO(datos), allow_pickle=False) as z:
+        cols = {}
+        for i, col in enumerate(json.loads(str(z["meta"]))["columnas"]):
+            v = z[f"c{i}"]
+            if col["tipo"] == "num":
+                cols[col["nombre"]] = v
+            elif col["tipo"] == "fecha":
+                cols[col["nombre"]] = v.view("datetime64[ns]")
+            elif col["tipo"] == "cat":
+                cols[col["nombre"]] = pd.Categorical.from_codes(v, categories=z[f"u{i}"])
+            else:
+                cols[col["nombre"]] = np.append(z[f"u{i}"].astype(object), None)[v]   # -1 → None
+    return pd.DataFrame(cols)
+
+# Escritor de auditoría: log_event solo encola; un hilo con conexión propia escribe por lotes
+LOG_LOTE_MAX = 500   # eventos por transacción como máximo
+SQL_INSERT_LOG = "INSERT INTO logs (ts, user, action, session_id, payload, result) VALUES (?, ?, ?, ?, ?, ?)"
+
+def _escribir_auditoria(escritor):
+    conn = _get_conn()   # una conexión para toda la vida del hilo (PRAGMAs una sola vez)
+    cola = escritor["cola"]
+    seguir = True
+    while seguir:
+        lote = [cola.get()]   # espera sin consumir CPU hasta que llega algo
+        while len(lote) < LOG_LOTE_MAX:
+            try:
+                lote.append(cola.get_nowait())
+            except queue.Empty:
+                break
+        eventos = [e for e in lote if isinstance(e, tuple)]
+        # La instantánea se comprime fuera de la transacción, evento a evento: si una
+        # falla, su fila de logs se escribe igual (sin plan) y el resto del lote no se pierde
+        preparados = []
+        for fila, plan in eventos:
+            datos = None
+            if plan is not None:
+                try:
+                    datos = (len(plan), plan_a_bytes(plan))
+                except Exception as e:
+                    escritor["error"] = f"instantánea no guardada: {e}"
+                    print(f"[AUDIT] No se pudo guardar la instantánea de '{fila[2]}': {e}")
+            preparados.append((fila, datos))
+        try:
+            if preparados:
+                with conn:   # un commit por lote; ids en el mismo orden que la cola
+                    sin_plan = []
+                    for fila, datos in preparados:
+                        if datos is None:
+                            sin_plan.append(fila)
+                            continue
+                        if sin_plan:   # tramos seguidos sin plan: executemany
+                            conn.executemany(SQL_INSERT_LOG, sin_plan)
+                            sin_plan = []
+                        log_id = conn.execute(SQL_INSERT_LOG, fila).lastrowid
+                        conn.execute("INSERT INTO planes (log_id, filas, bytes, datos) VALUES (?, ?, ?, ?)",
+                                     (log_id, datos[0], len(datos[1]), datos[1]))
+                    if sin_plan:
+                        conn.executemany(SQL_INSERT_LOG, sin_plan)
+                escritor["escritos"] += len(preparados)
+        except Exception as e:
+            escritor["error"] = str(e)
+            print(f"[AUDIT] Error al escribir {len(preparados)} eventos: {e}")
+        for e in lote:
+            if isinstance(e, threading.Event):   # marca de vaciado: todo lo anterior ya está en disco
+                e.set()
+            elif e is None:
+                seguir = False
+    conn.close()
+
+def _cerrar_auditoria(escritor, espera=5.0):
+    escritor["cola"].put(None)
+    escritor["hilo"].join(espera)
+
+@st.cache_resource
+def escritor_auditoria():
+    """Cola + hilo escritor, uno por proceso; al salir se escribe lo pendiente (atexit)."""
+    init_db()
+    escritor = {"cola": queue.SimpleQueue(), "escritos": 0, "error": None}
+    escritor["hilo"] = threading.Thread(target=_escribir_auditoria, args=(escritor,), daemon=True, name="auditoria")
+    escritor["hilo"].start()
+    atexit.register(_cerrar_auditoria, escritor)
+    return escritor
+
+@st.cache_data(max_entries=4, show_spinner=False)
+def cargar_plan_guardado(log_id):
+    """Propuestas guardadas con la fila log_id (las instantáneas no cambian: caché por id)."""
+    with _get_conn() as conn:
+        fila = conn.execute("SELECT datos FROM planes WHERE log_id = ?", (int(log_id),)).fetchone()
+    if fila is None:
+        raise ValueError(f"No hay plan guardado para el registro #{log_id}")
+    return plan_de_bytes(fila[0])
+
+def vaciar_auditoria(espera=5.0):
+    """Espera a que los eventos encolados estén en la base (p. ej. antes de leer el historial)."""
+    hecho = threading.Event()
+    escritor_auditoria()["cola"].put(hecho)
+    return hecho.wait(espera)
+
+# Consultas del historial: filtros y paginación por clave (id) en SQL
+PAGINA_HISTORIAL = 200
+
+def filtro_historial(usuario=None, accion=None, sesion=None, desde=None, hasta=None):
+    """(WHERE, parámetros) para los filtros del historial; fechas inclusive."""
+    cond, params = [], []
+    for columna, valor in (("user", usuario), ("action", accion), ("session_id", sesion)):
+        if valor:
+            cond.append(f"{columna} = ?")
+            params.append(valor)
+    if desde:
+        cond.append("ts >= ?")
+        params.append(desde.isoformat())
+    if hasta:
+        cond.append("ts < ?")
+        params.append((hasta + timedelta(days=1)).isoformat())
+    return (" WHERE " + " AND ".join(cond)) if cond else "", params
+
+def pagina_historial(filtro, antes_de=None, filas=PAGINA_HISTORIAL):
+    """
+    Una página de logs (id descendente) con id < antes_de. Se pide una fila de más
+    para saber si hay página siguiente. Devuelve (df, hay_mas).
+    """
+    where, params = filtro
+    if antes_de is not None:
+        where = (where + " AND id < ?") if where else " WHERE id < ?"
+        params = params + [int(antes_de)]
+    with _get_conn() as conn:
+        df = pd.read_sql_query(
+            f"SELECT id, ts, user, action, session_id, payload, result FROM logs{where} ORDER BY id DESC LIMIT ?",
+            conn, params=params + [filas + 1]
+        )
+    return df.head(filas), len(df) > filas
+
+@st.cache_data(ttl=60, show_spinner=False)
+def valores_historial(columna):
+    """Valores distintos de user/action (recorre solo el índice)."""
+    with _get_conn() as conn:
+        return [v for (v,) in conn.execute(f"SELECT DISTINCT {columna} FROM logs WHERE {columna} IS NOT NULL ORDER BY 1")]
+
+def csv_historial(filtro, filas_bloque=50_000):
+    """Todo el historial filtrado como CSV, leído por bloques (solo al pulsar la descarga)."""
+    vaciar_auditoria(espera=1.0)   # incluye lo que aún esté en cola
+    where, params = filtro
+    salida = io.StringIO()
+    with _get_conn() as conn:
+        bloques = pd.read_sql_query(
+            f"SELECT id, ts, user, action, session_id, payload, result FROM logs{where} ORDER BY id DESC",
+            conn, params=params, chunksize=filas_bloque
+        )
+        for n, bloque in enumerate(bloques):
+            bloque.to_csv(salida, index=False, header=(n == 0))
+    return salida.getvalue().encode("utf-8")
+
+def log_event(action, details=None, results=None, user=None, session_id=None, plan=None):
+    """
+    Registra una acción en el historial/auditoría (user/session_id explícitos fuera de una sesión).
+    Con plan (DataFrame de propuestas) se guarda además su instantánea, ligada a la fila del log.
+    """
     try:
-        init_db()
-        with _get_conn() as conn:
-            c = conn.cursor()
-            c.execute(
-                "INSERT INTO logs (ts, user, action, session_id, payload, result) VALUES (?, ?, ?, ?, ?, ?)",
-                (
-                    datetime.now().isoformat(),
-                    get_user(),
-                    str(action),
-                    get_session_id(),
-                    _safe_json(details),
-                    _safe_json(results),
-                )
-            )
-            conn.commit()
+        escritor_auditoria()["cola"].put(((
+            datetime.now().isoformat(),
+            user or get_user(),
+            str(action),
+            session_id or get_session_id(),
+            _safe_json(details),
+            _safe_json(results),
+        ), plan))
     except Exception as e:
         # No interrumpas la app si fallara el log; solo informa en consola
         print(f"[AUDIT] Error al registrar evento '{action}': {e}")
@@ -101,8 +308,8 @@ with st.sidebar:
     st.text_input("Identifícate (nombre o alias)", key="username", help="Se usará en el historial")
     st.caption(f"Session ID: `{get_session_id()}`")
 
-# Inicializa DB de logs apenas arranque
-init_db()
+# Inicializa DB de logs y el escritor en segundo plano apenas arranque (una vez por proceso)
+escritor_auditoria()
 
 # ------------------------------------------------------------
 # ESTILOS CSS (limpio; el centrado se hace con contenedores)
@@ -142,7 +349,8 @@ def guardar_archivo(archivo, nombre):
     """Guarda el archivo con nombre legible y timestamp. Devuelve la ruta."""
     if archivo is not None:
         t = datetime.now().strftime("%Y%m%d_%H%M%S")
-        p = os.path.join(UPLOAD_DIR, f"{nombre} {t}.xlsx")
+        ext = os.path.splitext(getattr(archivo, "name", ""))[1] or ".xlsx"
+        p = os.path.join(UPLOAD_DIR, f"{nombre} {t}{ext}")
         with open(p, "wb") as f:
             f.write(archivo.getbuffer())
         return p
@@ -169,11 +377,331 @@ def norm_code(code):
         digits = digits.zfill(4)
     return digits
 
+# Números que float() acepta tal cual; el resto pasa por la versión escalar
+_NUM_RE = r"[+-]?(?:[0-9]+\.?[0-9]*|\.[0-9]+)(?:[eE][+-]?[0-9]+)?"
+
+def to_float_safe_col(s, default=0.0):
+    """Versión por columna de to_float_safe (mismo resultado valor a valor)."""
+    s = pd.Series(s)
+    if pd.api.types.is_numeric_dtype(s):
+        return s.astype("float64").fillna(float(default))
+
+    # Se trabaja sobre los valores distintos y se expande con los códigos
+    codes, uniques = pd.factorize(s)
+    u = pd.Series(np.asarray(uniques, dtype=object), dtype=object)
+    es_txt = np.fromiter((isinstance(v, str) for v in u), dtype=bool, count=len(u))
+    txt = u.where(es_txt, "").str.replace(",", ".", regex=False)   # "" en los que no son texto
+    vals = np.full(len(u), float(default))
+    try:
+        # float() ya ignora los espacios: caso habitual, todo el bloque de golpe
+        vals[es_txt] = txt[es_txt].to_numpy(dtype=object).astype("float64")
+        resto = ~es_txt
+    except ValueError:
+        txt = txt.str.strip()
+        ok = es_txt & txt.str.fullmatch(_NUM_RE).fillna(False).to_numpy(dtype=bool)
+        vals[ok] = txt[ok].to_numpy(dtype=object).astype("float64")
+        resto = ~ok
+    if resto.any():
+        vals[resto] = [to_float_safe(v, default) for v in u[resto]]
+
+    out = np.full(len(s), float(default))
+    validos = codes >= 0
+    out[validos] = vals[codes[validos]]
+    return pd.Series(out, index=s.index)
+
+def norm_code_col(s):
+    """Versión por columna de norm_code (mismo resultado valor a valor)."""
+    s = pd.Series(s)
+    # factorize junta True con 1 y False con 0; en la versión escalar dan
+    # "True"/"False", así que los booleanos se factorizan por su texto
+    claves = s
+    if s.dtype == bool:
+        claves = s.astype(str)
+    elif s.dtype == object:
+        es_bool = s.map(lambda v: isinstance(v, (bool, np.bool_))).to_numpy(dtype=bool)
+        if es_bool.any():
+            claves = s.copy()
+            claves[es_bool] = s[es_bool].astype(str)
+    codes, uniques = pd.factorize(claves)
+    txt = pd.Series([str(v) for v in uniques], dtype=object).str.strip()
+    txt = txt.where(~txt.str.endswith(".0"), txt.str[:-2])
+    digits = txt.str.replace(r"[^0-9]", "", regex=True)
+    res = digits.where(digits == "", digits.str.zfill(4))
+    res = res.where(digits != "", txt)
+
+    # Dígitos no ASCII (isdigit ≠ [0-9]): se resuelven con la versión escalar
+    no_ascii = txt.str.contains(r"[^\x00-\x7f]", regex=True).to_numpy(dtype=bool)
+    if no_ascii.any():
+        res[no_ascii] = [norm_code(v) for v in uniques[no_ascii]]
+
+    nulos = codes < 0
+    out = np.empty(len(s), dtype=object)
+    out[~nulos] = res.to_numpy(dtype=object)[codes[~nulos]]
+    # Nulos (None/NaN/NaT) se distinguen en str(); se resuelven uno a uno
+    if nulos.any():
+        out[nulos] = [norm_code(v) for v in s[nulos]]
+    return pd.Series(out, index=s.index)
+
+# ------------------------------------------------------------
+# CLAVES CODIFICADAS (categorías) Y MEDIDAS DE RENDIMIENTO
+# ------------------------------------------------------------
+CLAVES_CATEGORICAS = ["Material", "Unidad", "Centro", "Semana"]
+
+def codificar_claves(df, extra=()):
+    """
+    Codifica una sola vez las claves de texto como categorías (diccionario + códigos)
+    y reduce los numéricos cuando no se pierde nada. Se aplica al cargar cada maestro.
+    """
+    df = df.copy()
+    df.columns = df.columns.astype(str).str.strip()
+    col_cli = detectar_columna_cliente(df)
+    claves = [c for c in [*CLAVES_CATEGORICAS, col_cli, *extra] if c and c in df.columns]
+    for c in dict.fromkeys(claves):
+        if not isinstance(df[c].dtype, pd.CategoricalDtype):
+            df[c] = df[c].astype("category")
+
+    for c in df.columns:
+        col = df[c]
+        if pd.api.types.is_bool_dtype(col) or not pd.api.types.is_numeric_dtype(col):
+            continue
+        if pd.api.types.is_integer_dtype(col):
+            df[c] = pd.to_numeric(col, downcast="integer")
+        elif pd.api.types.is_float_dtype(col) and col.dtype != "float32":
+            col32 = col.astype("float32")
+            if ((col32.astype("float64") == col) | col.isna()).all():
+                df[c] = col32
+    return df
+
+# Hilos sin sesión (vigilante de carpeta) dejan aquí sus métricas en vez de en session_state
+_metricas_hilo = threading.local()
+
+def registrar_metrica(etapa, **valores):
+    """Anota una medida de rendimiento de la sesión (se ve en «⏱ Rendimiento»)."""
+    fila = {"hora": datetime.now().strftime("%H:%M:%S"), "etapa": etapa, **valores}
+    destino = getattr(_metricas_hilo, "lista", None)
+    if destino is not None:
+        destino.append(fila)
+    else:
+        st.session_state.setdefault("metricas", []).append(fila)
+
+def medida_cruce(df_izq, maestro, claves_maestro, df):
+    """
+    Ancho y memoria del cruce proyectado (`df`) frente a los de un merge con el maestro
+    entero (antes de proyectar). El segundo se estima sin hacerlo: memoria de `df_izq`
+    más, por cada columna que traería el merge, sus bytes medios por fila del maestro.
+    """
+    extra = [c for c in maestro.columns if c not in claves_maestro]
+    por_fila = maestro[extra].memory_usage(deep=True, index=False).sum() / max(len(maestro), 1)
+    completo = df_izq.memory_usage(deep=True, index=False).sum() + por_fila * len(df_izq)
+    return {"columnas": df.shape[1], "memoria_mb": round(df.memory_usage(deep=True, index=False).sum() / 1e6, 3),
+            "columnas_merge_completo": df_izq.shape[1] + len(extra), "memoria_merge_completo_mb": round(completo / 1e6, 3)}
+
+def memoria_sesion():
+    """Memoria (MB) de los DataFrames de la sesión: actual y con claves como texto."""
+    filas = []
+    for k, v in st.session_state.items():
+        if not isinstance(v, pd.DataFrame):
+            continue
+        actual = v.memory_usage(deep=True, index=False).sum()
+        texto = actual
+        for c in v.columns:
+            if isinstance(v[c].dtype, pd.CategoricalDtype):
+                texto += v[c].astype(object).memory_usage(deep=True, index=False) - v[c].memory_usage(deep=True, index=False)
+        filas.append({"tabla": str(k), "filas": len(v), "MB": actual / 2**20, "MB claves texto": texto / 2**20})
+    return pd.DataFrame(filas)
+
+def carga_semanal(df):
+    """Horas por Semana × Centro; se agrupa sobre códigos y solo el resultado pasa a texto."""
+    carga = df.groupby(["Semana", "Centro"], observed=True)["Horas"].sum().unstack().fillna(0)
+    carga.index = carga.index.astype(str)
+    carga.columns = carga.columns.astype(str)
+    return carga.sort_index()
+
 def semana_iso_str_from_ts(ts: pd.Timestamp) -> str:
     """Devuelve semana ISO como 'YYYY-Www' (lunes-domingo)."""
     iso = ts.isocalendar()
     return f"{int(iso.year)}-W{int(iso.week):02d}"
 
+# ------------------------------------------------------------
+# FECHAS COMO DÍAS ENTEROS (se normalizan una sola vez en la ingesta)
+# ------------------------------------------------------------
+EPOCA = datetime(1970, 1, 1)
+EPOCA_EXCEL = 25569   # serial Excel del 01.01.1970
+FORMATOS_FECHA = ["%d.%m.%Y", "%d/%m/%Y", "%Y-%m-%d", "%d-%m-%Y", "%Y-%m-%d %H:%M:%S", "%d.%m.%Y %H:%M:%S"]
+_formato_fecha = {"ultimo": FORMATOS_FECHA[0]}   # el último formato que funcionó se prueba primero
+
+def _dias_desde_texto(textos):
+    """Textos únicos → datetime con formato explícito (nunca mes/día intercambiados)."""
+    orden = [_formato_fecha["ultimo"]] + [f for f in FORMATOS_FECHA if f != _formato_fecha["ultimo"]]
+    dt = pd.Series(pd.NaT, index=textos.index, dtype="datetime64[ns]")
+    for fmt in orden:
+        falta = dt.isna()
+        if not falta.any():
+            break
+        parcial = pd.to_datetime(textos[falta], format=fmt, errors="coerce")
+        if parcial.notna().any():
+            dt[falta] = parcial
+            _formato_fecha["ultimo"] = fmt
+    falta = dt.isna()
+    if falta.any():
+        dt[falta] = pd.to_datetime(textos[falta], dayfirst=True, errors="coerce")
+    return dt
+
+def dias_o_nulos(s):
+    """
+    Columna de fechas → días desde el 01.01.1970 (float64), con NaN en las filas
+    vacías o que no son una fecha. Se convierte sobre los valores únicos.
+    """
+    codes, unicos = pd.factorize(s)
+    u = pd.Series(np.asarray(unicos, dtype=object))
+    dias = np.full(len(u), np.nan)
+    es_fecha = u.map(lambda v: isinstance(v, (date, np.datetime64))).to_numpy(dtype=bool)
+    if es_fecha.any():
+        dias[es_fecha] = pd.to_datetime(u[es_fecha]).to_numpy(dtype="datetime64[D]").astype(np.int64)
+    num = pd.to_numeric(u.where(~es_fecha), errors="coerce").to_numpy(dtype=float)
+    es_serial = ~es_fecha & ~np.isnan(num)
+    dias[es_serial] = np.floor(num[es_serial]) - EPOCA_EXCEL
+    es_texto = ~es_fecha & ~es_serial
+    if es_texto.any():
+        dt = _dias_desde_texto(u[es_texto].astype(str).str.strip())
+        dias[es_texto] = dt.to_numpy(dtype="datetime64[D]").astype(np.int64)
+        dias[np.flatnonzero(es_texto)[dt.isna().to_numpy()]] = np.nan
+
+    out = np.full(len(codes), np.nan)
+    validos = codes >= 0
+    out[validos] = dias[codes[validos]]
+    return out
+
+def fechas_a_dias(s):
+    """
+    Columna de fechas (serial Excel, datetime o texto dd.mm.yyyy) → días desde el
+    01.01.1970 (int32). Si algún valor no es una fecha se lanza ValueError.
+    """
+    if pd.api.types.is_datetime64_any_dtype(s) and s.notna().all():
+        return s.to_numpy(dtype="datetime64[D]").astype(np.int32)
+    if pd.api.types.is_numeric_dtype(s) and s.notna().all():
+        # Serial Excel: ruta rápida sin pasar por texto
+        return (np.floor(s.to_numpy(dtype=float)) - EPOCA_EXCEL).astype(np.int32)
+
+    dias = dias_o_nulos(s)
+    malos = np.isnan(dias)
+    if malos.any():
+        ejemplos = ", ".join(map(str, pd.unique(pd.Series(s)[malos].dropna())[:3])) or "vacía"
+        raise ValueError(f"Fechas no válidas en «{s.name}»: {ejemplos}")
+    return dias.astype(np.int32)
+
+def dias_a_fechas(dias):
+    return pd.to_datetime(np.asarray(dias, dtype="int64"), unit="D")
+
+@lru_cache(maxsize=None)
+def texto_de_dia(dia):
+    return (EPOCA + timedelta(days=int(dia))).strftime("%d.%m.%Y")
+
+@lru_cache(maxsize=None)
+def semana_de_dia(dia):
+    return semana_iso_str_from_ts(EPOCA + timedelta(days=int(dia)))
+
+# ------------------------------------------------------------
+# CALENDARIO DE PLANIFICACIÓN (una tabla por horizonte)
+# ------------------------------------------------------------
+def leer_festivos(df_cap):
+    """Columna opcional «Festivos» de Capacidad: días no laborables por centro (separados por , o ;)."""
+    col = next((c for c in df_cap.columns if str(c).strip().lower() in ("festivos", "festivo", "no laborables")), None)
+    if col is None:
+        return {}
+    festivos = {}
+    for centro, valor in zip(norm_code_col(df_cap["Centro"]), df_cap[col]):
+        if isinstance(valor, (date, np.datetime64)):
+            partes = [valor]
+        elif pd.isna(valor):
+            continue
+        else:
+            partes = [p.strip() for p in re.split(r"[;,]", str(valor)) if p.strip()]
+        if partes:
+            festivos.setdefault(centro, set()).update(fechas_a_dias(pd.Series(partes, name=col)).tolist())
+    return festivos
+
+def construir_calendario(dia_ini, dia_fin, centros, festivos=None, perfil=None):
+    """
+    Tabla de días [dia_ini, dia_fin]: día entero, texto dd.mm.yyyy, semana ISO y una
+    columna booleana por centro (laborable). Festivos y perfil de capacidad quedan en
+    attrs para poder ampliarla y compilar la capacidad (matriz_capacidad).
+    """
+    festivos = festivos or {}
+    dias = np.arange(int(dia_ini), int(dia_fin) + 1)
+    fechas = dias_a_fechas(dias)
+    iso = fechas.isocalendar()
+    cal = pd.DataFrame({
+        "Dia": dias,
+        "Fecha": fechas.strftime("%d.%m.%Y"),
+        "Semana": [f"{y}-W{w:02d}" for y, w in zip(iso["year"], iso["week"])],
+    })
+    for c in centros:
+        cal[c] = ~np.isin(dias, list(festivos.get(c, ())))
+    cal.attrs["festivos"] = festivos
+    cal.attrs["perfil"] = perfil or []
+    return cal
+
+def matriz_capacidad(calendario, centros, capacidades):
+    """
+    Capacidad diaria como matriz densa centro × día del horizonte del calendario:
+    capacidad general del centro, sustituida por las filas con fecha del perfil
+    (en orden) y a cero en los días no laborables.
+    """
+    dias = calendario["Dia"].to_numpy()
+    dia0, n = int(dias[0]), len(dias)
+    fila = {c: i for i, c in enumerate(centros)}
+    cap = np.repeat(np.array([float(capacidades.get(c, 0.0)) for c in centros])[:, None], n, axis=1)
+    for centro, desde, hasta, horas in calendario.attrs.get("perfil", []):
+        a, b = max(desde - dia0, 0), min(hasta - dia0 + 1, n)
+        if centro in fila and a < b:
+            cap[fila[centro], a:b] = horas
+    for c, i in fila.items():
+        if c in calendario.columns:
+            cap[i, ~calendario[c].to_numpy(dtype=bool)] = 0.0
+    return cap
+
+def liberar_capacidad(libro, inicio, calendario, capacidades):
+    """Copia del libro con la capacidad de cada centro repuesta desde su día de `inicio`."""
+    if "restante" not in libro:
+        return {}
+    libro = {**libro, "restante": libro["restante"].copy()}
+    n = libro["restante"].shape[1]
+    atributos = dict(calendario.attrs) if calendario is not None else {}
+    tabla = construir_calendario(libro["dia0"], libro["dia0"] + n - 1, libro["centros"], **atributos)
+    base = matriz_capacidad(tabla, libro["centros"], capacidades)
+    for centro, desde in inicio.items():
+        if centro in libro["centros"]:
+            i = libro["centros"].index(centro)
+            a = max(int(desde) - libro["dia0"], 0)
+            libro["restante"][i, a:] = base[i, a:]
+    return libro
+
+def siguiente_laborable(laborable):
+    """Para cada posición, índice del primer día laborable en o después de ella (len si no hay)."""
+    n = len(laborable)
+    idx = np.where(laborable, np.arange(n), n)
+    return np.minimum.accumulate(idx[::-1])[::-1]
+
+def normalizar_fechas_demanda(df, descartar_invalidas=False):
+    """
+    Añade el día interno ("Dia") y deja la Fecha de necesidad como datetime normalizado.
+    Con `descartar_invalidas` las líneas sin fecha válida se quitan en lugar de lanzar
+    ValueError (en la carga ya quedan en el informe de validación como error).
+    """
+    df = df.copy()
+    try:
+        df["Dia"] = fechas_a_dias(df["Fecha de necesidad"])
+    except ValueError:
+        if not descartar_invalidas:
+            raise
+        dias = dias_o_nulos(df["Fecha de necesidad"])
+        validas = ~np.isnan(dias)
+        df = df[validas].reset_index(drop=True)
+        df["Dia"] = dias[validas].astype(np.int32)
+    df["Fecha de necesidad"] = dias_a_fechas(df["Dia"])
+    return df
+
 def detectar_columna_cliente(df):
     posibles = [
         "cliente","client","customer",
@@ -187,26 +715,280 @@ def detectar_columna_cliente(df):
                 return orig
     return None
 
+def _tipar_como_excel(col):
+    """Claves leídas como texto → enteros si todas lo son (igual que read_excel)."""
+    num = pd.to_numeric(col, errors="coerce")
+    if num.notna().all() and (num % 1 == 0).all():
+        return num.astype("int64")
+    return col
+
+def _detectar_separador(archivo):
+    """Separador de un CSV a partir de su cabecera (ERP: ';' por defecto)."""
+    muestra = archivo.read(64 * 1024)
+    archivo.seek(0)
+    if isinstance(muestra, bytes):
+        muestra = muestra.decode("utf-8-sig", errors="ignore")
+    try:
+        return csv.Sniffer().sniff(muestra.splitlines()[0], delimiters=";,\t|").delimiter
+    except (csv.Error, IndexError):
+        return ";"
+
+def leer_tabla(archivo):
+    """Lee un xlsx o un CSV pequeño (sin agregar) con columnas limpias."""
+    if archivo.name.lower().endswith(".csv"):
+        df = pd.read_csv(archivo, sep=_detectar_separador(archivo), dtype=str, encoding="utf-8-sig")
+    else:
+        df = pd.read_excel(archivo)
+    df.columns = df.columns.astype(str).str.strip()
+    return df
+
+def _tramos_xlsx(archivo, filas_bloque):
+    """
+    Primera hoja de un xlsx en DataFrames de `filas_bloque` filas, leída en streaming
+    (openpyxl read_only): la hoja completa nunca está en memoria. El índice sigue la
+    numeración de read_excel (fila de datos desde 0) aunque se salten filas vacías.
+    """
+    libro = load_workbook(archivo, read_only=True, data_only=True)
+    try:
+        filas = libro.worksheets[0].iter_rows(values_only=True)
+        cabecera = next(filas, None)
+        if cabecera is None:
+            return
+        columnas = [str(c) if c is not None else f"Unnamed: {i}" for i, c in enumerate(cabecera)]
+        tramo, indice = [], []
+        for i, fila in enumerate(filas):
+            if all(v is None for v in fila):
+                continue
+            tramo.append(fila[:len(columnas)])
+            indice.append(i)
+            if len(tramo) == filas_bloque:
+                yield pd.DataFrame(tramo, columns=columnas, index=indice)
+                tramo, indice = [], []
+        if tramo:
+            yield pd.DataFrame(tramo, columns=columnas, index=indice)
+    finally:
+        libro.close()
+
+def bloques_demanda(archivo, filas_bloque=CSV_FILAS_BLOQUE):
+    """
+    Recorre una Demanda (CSV por trozos; xlsx por tramos) y produce, por bloque, sus
+    claves, el bloque con Material, Unidad, Cliente, Dia y Cantidad ya normalizados, las
+    líneas leídas y el informe de validar_hoja sobre el bloque tal como venía.
+    Las líneas sin fecha válida quedan en el informe y fuera del bloque.
+    """
+    if archivo.name.lower().endswith(".csv"):
+        lector = pd.read_csv(archivo, sep=_detectar_separador(archivo), dtype=str,
+                             chunksize=filas_bloque, encoding="utf-8-sig")
+    else:
+        lector = _tramos_xlsx(archivo, min(filas_bloque, XLSX_FILAS_BLOQUE))
+    claves = None
+    for bloque in lector:
+        bloque.columns = bloque.columns.astype(str).str.strip()
+        if claves is None:
+            col_cli = detectar_columna_cliente(bloque)
+            faltan = {"Material", "Unidad", "Fecha de necesidad", "Cantidad"} - set(bloque.columns)
+            if faltan or not col_cli:
+                raise ValueError("Faltan columnas en Demanda: " + ", ".join(sorted(faltan) or ["cliente"]))
+            claves = ["Material", "Unidad", col_cli, "Dia"]
+
+        # Antes de convertir y agregar: cantidades y fechas crudas, con la fila del archivo
+        incidencias = validar_hoja("df_dem", bloque)
+        lineas = len(bloque)
+        bloque = bloque[claves[:3] + ["Fecha de necesidad", "Cantidad"]].copy()
+        for c in claves[:3]:
+            bloque[c] = bloque[c].astype(str).str.strip().where(bloque[c].notna())
+        dias = dias_o_nulos(bloque["Fecha de necesidad"])
+        validas = ~np.isnan(dias)
+        if not validas.all():
+            bloque, dias = bloque[validas], dias[validas]
+        bloque["Dia"] = dias.astype(np.int32)
+        bloque["Cantidad"] = to_float_safe_col(bloque["Cantidad"], 0)
+        yield claves, bloque, lineas, incidencias
+
+def _demanda_agregada(df_dem, claves):
+    """Agregado (Material, Unidad, Cliente, Dia) → df_dem con los tipos de read_excel y su fecha."""
+    for c in claves[:3]:
+        df_dem[c] = _tipar_como_excel(df_dem[c])
+    df_dem.insert(3, "Fecha de necesidad", dias_a_fechas(df_dem["Dia"]))
+    return df_dem
+
+def leer_demanda_csv_por_bloques(archivo, filas_bloque=CSV_FILAS_BLOQUE):
+    """
+    Lee una Demanda CSV por bloques, agregando cada bloque a
+    (Material, Unidad, Cliente, Fecha de necesidad) antes de combinarlo.
+    La memoria queda acotada por las claves distintas, no por las líneas.
+    Devuelve (df_dem agregado, nº de líneas leídas, informe de validación por línea).
+    """
+    acumulado = None
+    lineas = 0
+    informes = []
+    for claves, bloque, n, incidencias in bloques_demanda(archivo, filas_bloque):
+        lineas += n
+        informes.append(incidencias)
+        parcial = bloque.groupby(claves, dropna=False, sort=False)["Cantidad"].sum()
+        if acumulado is not None:
+            parcial = pd.concat([acumulado, parcial])
+            parcial = parcial.groupby(level=list(range(len(claves))), dropna=False, sort=False).sum()
+        acumulado = parcial
+
+    if acumulado is None:
+        raise ValueError("El CSV de Demanda está vacío.")
+    return _demanda_agregada(acumulado.reset_index(), claves), lineas, _informe(informes)
+
+def agregar_demanda_en_sqlite(archivo, ruta, filas_bloque=CSV_FILAS_BLOQUE):
+    """
+    Modo en disco para demandas muy grandes (CSV o xlsx, ambos leídos por bloques): las
+    líneas se vuelcan a una base SQLite temporal (`ruta`) indexada por clave, y el GROUP BY
+    a (Material, Unidad, Cliente, Día) lo hace SQLite. A memoria solo vuelve el agregado;
+    la base se borra al terminar.
+    Devuelve (df_dem agregado, nº de líneas leídas, informe de validación por línea).
+    """
+    if os.path.exists(ruta):
+        os.remove(ruta)
+    conn = sqlite3.connect(ruta)
+    try:
+        # Base de trabajo desechable: sin diario ni esperas de disco en la carga masiva
+        conn.execute("PRAGMA journal_mode=OFF;")
+        conn.execute("PRAGMA synchronous=OFF;")
+        conn.execute("CREATE TABLE demanda (material TEXT, unidad TEXT, cliente TEXT, dia INTEGER, cantidad REAL)")
+        claves, lineas, informes = None, 0, []
+        for claves, bloque, n, incidencias in bloques_demanda(archivo, filas_bloque):
+            # Columnas como listas de Python (SQLite no enlaza escalares numpy), por tramos
+            for i in range(0, len(bloque), STAGING_FILAS_INSERT):
+                tramo = bloque.iloc[i:i + STAGING_FILAS_INSERT]
+                conn.executemany(
+                    "INSERT INTO demanda VALUES (?, ?, ?, ?, ?)",
+                    zip(*(tramo[c].tolist() for c in claves + ["Cantidad"]))
+                )
+            lineas += n
+            informes.append(incidencias)
+        if not lineas:
+            raise ValueError("La Demanda está vacía.")
+        # El índice por clave se crea tras la carga (más rápido) y cubre el GROUP BY
+        conn.execute("CREATE INDEX ix_demanda_clave ON demanda (material, unidad, cliente, dia, cantidad)")
+        conn.commit()
+        # El agregado se lee por tramos para no materializar todas las tuplas de golpe
+        df_dem = pd.concat(pd.read_sql_query(
+            "SELECT material, unidad, cliente, dia, SUM(cantidad) AS cantidad FROM demanda "
+            "GROUP BY material, unidad, cliente, dia",
+            conn, chunksize=filas_bloque
+        ), ignore_index=True)
+    finally:
+        conn.close()
+        if os.path.exists(ruta):
+            os.remove(ruta)
+    df_dem.columns = claves + ["Cantidad"]
+    df_dem["Dia"] = df_dem["Dia"].astype(np.int32)
+    return _demanda_agregada(df_dem, claves), lineas, _informe(informes)
+
+# Valores de la columna «Operación» de un delta que eliminan la línea
+OPS_BAJA = {"B", "BAJA", "D", "DEL", "DELETE", "ELIMINAR", "BORRAR"}
+
+def bajas_por_operacion(df_delta):
+    """Líneas del delta marcadas como baja en la columna «Operación» (si la hay)."""
+    col_op = next((c for c in df_delta.columns if c.lower().startswith(("operaci", "accion", "acción"))), None)
+    if col_op is None:
+        return np.zeros(len(df_delta), dtype=bool)
+    return df_delta[col_op].astype(str).str.strip().str.upper().isin(OPS_BAJA).to_numpy()
+
+def aplicar_delta_demanda(df_dem, df_delta):
+    """
+    Fusiona un archivo de cambios con la demanda guardada. Cada línea del delta fija
+    la cantidad de su clave (Material, Unidad, Cliente, Fecha de necesidad) y sustituye
+    a las líneas guardadas con esa clave; con Operación = B/BAJA o Cantidad 0 la clave
+    se elimina. Devuelve (demanda nueva, resumen de altas/cambios/bajas).
+    """
+    col_cli = detectar_columna_cliente(df_dem)
+    col_cli_delta = detectar_columna_cliente(df_delta)
+    faltan = {"Material", "Unidad", "Fecha de necesidad", "Cantidad"} - set(df_delta.columns)
+    if faltan or not col_cli_delta:
+        raise ValueError("Faltan columnas en el delta: " + ", ".join(sorted(faltan) or ["cliente"]))
+
+    claves = ["Material", "Unidad", col_cli, "Dia"]
+    df_delta = normalizar_fechas_demanda(df_delta.rename(columns={col_cli_delta: col_cli}))
+    if "Dia" not in df_dem.columns:
+        df_dem = normalizar_fechas_demanda(df_dem)
+    df_delta["Cantidad"] = to_float_safe_col(df_delta["Cantidad"], 0)
+    for c in claves[:3]:
+        df_delta[c] = _tipar_como_excel(df_delta[c].astype(str).str.strip())
+
+    baja = (df_delta["Cantidad"] <= 0).to_numpy(copy=True) | bajas_por_operacion(df_delta)
+
+    def indice(df):
+        # Claves comparables aunque lleguen con otro tipo (categoría, texto, número)
+        return pd.MultiIndex.from_arrays([
+            df[c] if c == "Dia" else df[c].astype(str).str.strip()
+            for c in claves
+        ])
+
+    idx_dem, idx_delta = indice(df_dem), indice(df_delta)
+    existe = idx_delta.isin(idx_dem)
+    tocadas = idx_dem.isin(idx_delta)
+
+    nuevas = df_delta.loc[~baja, [c for c in df_dem.columns if c in df_delta.columns]]
+    conservadas = df_dem.loc[~tocadas]
+    conservadas = conservadas.astype({c: object for c in conservadas.columns if isinstance(conservadas[c].dtype, pd.CategoricalDtype)})
+    df_nueva = codificar_claves(pd.concat([conservadas, nuevas], ignore_index=True))
+
+    resumen = {
+        "lineas_delta": int(len(df_delta)),
+        "altas": int((~existe & ~baja).sum()),
+        "cambios": int((existe & ~baja).sum()),
+        "bajas": int((existe & baja).sum()),
+    }
+    return df_nueva, resumen
+
+def _columna_capacidad(df_cap):
+    for c in df_cap.columns:
+        low = c.lower().strip()
+        if low == "capacidad horas" or ("capacidad" in low and "hora" in low):
+            return c
+    return None
+
+def _columnas_fecha_capacidad(df_cap):
+    """(col. desde, col. hasta) de las filas con fecha: «Fecha» o «Fecha desde»/«Fecha hasta»."""
+    low = {c.lower().strip(): c for c in df_cap.columns}
+    desde = low.get("fecha desde") or low.get("desde") or low.get("fecha")
+    hasta = low.get("fecha hasta") or low.get("hasta") or desde
+    return desde, hasta
+
 def leer_capacidades(df_cap):
+    """Capacidad general (horas/día) por centro: filas sin fecha. Con solo filas con fecha, 0."""
     if "Centro" not in df_cap.columns:
-        st.error("❌ Falta la columna 'Centro' en Capacidad")
-        st.stop()
+        raise ValueError("Falta la columna 'Centro' en Capacidad")
 
-    col_lower = {c: c.lower().strip() for c in df_cap.columns}
-    cap_col = None
-    for c, low in col_lower.items():
-        if low == "capacidad horas" or ("capacidad" in low and "hora" in low):
-            cap_col = c
-            break
+    cap_col = _columna_capacidad(df_cap)
     if cap_col is None:
-        st.error("❌ No se encuentra la columna 'Capacidad horas' en Capacidad")
-        st.stop()
-
-    capacidades = {}
-    for _, r in df_cap.iterrows():
-        capacidades[norm_code(r["Centro"])] = to_float_safe(r[cap_col], 0)
+        raise ValueError("No se encuentra la columna 'Capacidad horas' en Capacidad")
+
+    centros = norm_code_col(df_cap["Centro"])
+    horas = to_float_safe_col(df_cap[cap_col], 0)
+    desde, _ = _columnas_fecha_capacidad(df_cap)
+    sin_fecha = df_cap[desde].isna().to_numpy() if desde else np.ones(len(df_cap), dtype=bool)
+    capacidades = dict.fromkeys(centros, 0.0)
+    capacidades.update(zip(centros[sin_fecha], horas[sin_fecha]))
     return capacidades
 
+def leer_perfil_capacidad(df_cap):
+    """
+    Filas con fecha de Capacidad (turnos, mantenimientos, semanas especiales) →
+    [(centro, día desde, día hasta, horas/día)], en el orden del archivo.
+    """
+    desde, hasta = _columnas_fecha_capacidad(df_cap)
+    cap_col = _columna_capacidad(df_cap)
+    if not desde or cap_col is None:
+        return []
+    con_fecha = df_cap[desde].notna()
+    if not con_fecha.any():
+        return []
+    filas = df_cap.loc[con_fecha]
+    d1 = fechas_a_dias(filas[desde])
+    d2 = fechas_a_dias(filas[hasta].fillna(filas[desde]))
+    return list(zip(
+        norm_code_col(filas["Centro"]).tolist(), d1.tolist(), np.maximum(d1, d2).tolist(),
+        to_float_safe_col(filas[cap_col], 0).tolist()
+    ))
+
 def detectar_centros_desde_capacidades(capacidades):
     keys = list(capacidades.keys())
     DG = next((k for k in keys if k.endswith("833")), keys[0])
@@ -240,47 +1022,134 @@ def repartir_porcentaje(df_semana, pct_dg, dg, mch):
 # ------------------------------------------------------------
 # Planificador por lotes con capacidad diaria
 # ------------------------------------------------------------
-def modo_C(df_agr, df_mat, capacidades, DG_code, MCH_code):
-    tiempos = df_mat[[
-        "Material","Unidad",
+def modo_C(df_agr, df_mat, capacidades, DG_code, MCH_code, capacidad_restante=None, calendario=None):
+    """
+    Planificador por lotes con capacidad diaria.
+    `capacidad_restante` es el libro de capacidad (matriz densa centro × día, ver
+    matriz_capacidad); permite partir de lo ya consumido y se actualiza en sitio para
+    que el llamador lo conserve. `calendario` (construir_calendario) da textos/semanas
+    por índice de día; los días sin capacidad de cada centro se saltan sin iterar.
+    """
+    # Solo tiempos y lotes del maestro, por índice (Material, Unidad) → fila
+    tiempos = df_mat.drop_duplicates(["Material","Unidad"])
+    cols = [c for c in [
         "Tiempo fabricación unidad DG",
         "Tiempo fabricación unidad MCH",
         "Tamaño lote mínimo","Tamaño lote máximo"
-    ]].drop_duplicates()
+    ] if c not in df_agr.columns]
+    df = cruzar_columnas(df_agr, ["Material","Unidad"], tiempos, ["Material","Unidad"], cols)
+    registrar_metrica("cruce_tiempos", filas_entrada=len(df_agr), filas_salida=len(df),
+                      **medida_cruce(df_agr, tiempos, ["Material","Unidad"], df))
 
-    df = df_agr.merge(tiempos, on=["Material","Unidad"], how="left")
+    libro = capacidad_restante if capacidad_restante is not None else {}
+    cal = {}
 
-    capacidad_restante = {}
     def get_cap(centro, fecha):
-        key = (centro, fecha)
-        if key not in capacidad_restante:
-            capacidad_restante[key] = capacidades.get(centro, 0)
-        return capacidad_restante[key]
+        return float(libro["restante"][cal["fila"][centro], fecha - cal["dia0"]])
 
     def consume(centro, fecha, h):
-        capacidad_restante[(centro, fecha)] = max(0.0, get_cap(centro, fecha) - h)
+        i, j = cal["fila"][centro], fecha - cal["dia0"]
+        libro["restante"][i, j] = max(0.0, libro["restante"][i, j] - h)
+        if libro["restante"][i, j] <= 0:
+            cal["sig"][centro][j] = j + 1   # día agotado: se enlaza con el siguiente
 
-    def horas_nec(centro, qty, r):
-        tu = r["Tiempo fabricación unidad DG"] if centro == DG_code else r["Tiempo fabricación unidad MCH"]
-        return qty * to_float_safe(tu)
+    def horas_nec(qty, tu):
+        return qty * tu
 
-    def cant_por_cap(centro, cap_h, r):
-        tu = r["Tiempo fabricación unidad DG"] if centro == DG_code else r["Tiempo fabricación unidad MCH"]
-        tu = to_float_safe(tu)
+    def cant_por_cap(cap_h, tu):
         if tu == 0: return 0
         return cap_h / tu
 
+    def columna_float(nombres, default):
+        # Primera columna presente (como r.get encadenado), convertida en bloque
+        for n in nombres:
+            if n in df.columns:
+                return to_float_safe_col(df[n], default).to_numpy()
+        return np.full(len(df), float(default))
+
+    # Conversión de columnas una sola vez (antes: to_float_safe/norm_code por fila)
+    centros = norm_code_col(df["Centro"]).to_numpy(dtype=object)
+    tiempos_u = np.where(
+        centros == DG_code,
+        columna_float(["Tiempo fabricación unidad DG"], 0.0),
+        columna_float(["Tiempo fabricación unidad MCH"], 0.0)
+    )
+    cantidades = columna_float(["Cantidad"], 0)
+    lotes_min = columna_float(["Lote_min", "Tamaño lote mínimo"], 0)
+    lotes_max = columna_float(["Lote_max", "Tamaño lote máximo"], 1)
+
     out = []
     contador = 1
 
-    for _, r in df.iterrows():
-        centro = norm_code(r["Centro"])
-        fecha = pd.to_datetime(r["Fecha"]).normalize()
-        semana = semana_iso_str_from_ts(fecha)
+    # Días enteros desde el 01.01.1970 (columna "Dia"; si solo llega "Fecha" se convierte una vez)
+    dias = df["Dia"].to_numpy() if "Dia" in df.columns else fechas_a_dias(df["Fecha"])
+    # Fecha de necesidad original (interna): distinta del día si el resto de un lote se replanifica
+    necesidades = df["Necesidad"].to_numpy() if "Necesidad" in df.columns else dias
+
+    filas = zip(
+        df["Material"].tolist(), df["Unidad"].tolist(), centros, dias.tolist(),
+        cantidades.tolist(), lotes_min.tolist(), lotes_max.tolist(), tiempos_u.tolist(),
+        necesidades.tolist()
+    )
+    # Calendario y capacidad restante comparten horizonte; si un desborde pasa del
+    # último día se amplían juntos (duplicando) conservando lo ya consumido
+    centros_cal = sorted(set(centros.tolist()) | set(capacidades) | set(libro.get("centros", [])))
+    atributos = dict(calendario.attrs) if calendario is not None else {}
+
+    def cargar_horizonte(tabla):
+        dia0, n = int(tabla["Dia"].iat[0]), len(tabla)
+        base = matriz_capacidad(tabla, centros_cal, capacidades)
+        restante = base.copy()
+        if "restante" in libro:
+            previo, desplaz = libro["restante"], libro["dia0"] - dia0
+            m = min(previo.shape[1], n - desplaz)
+            for i, c in enumerate(libro["centros"]):
+                restante[centros_cal.index(c), desplaz:desplaz + m] = previo[i, :m]
+        libro.update(dia0=dia0, centros=centros_cal, restante=restante)
+        cal.update(
+            dia0=dia0, n=n,
+            texto=tabla["Fecha"].to_numpy(), semana=tabla["Semana"].to_numpy(),
+            fila={c: i for i, c in enumerate(centros_cal)},
+            # Siguiente día con capacidad restante por centro (festivos y días agotados
+            # se saltan de una vez; los saltos se comprimen al recorrerlos)
+            sig={c: siguiente_laborable(restante[i] > 0).tolist() for i, c in enumerate(centros_cal)},
+        )
 
-        cantidad = to_float_safe(r.get("Cantidad", 0), 0)
-        lote_min = to_float_safe(r.get("Lote_min", r.get("Tamaño lote mínimo", 0)), 0)
-        lote_max = to_float_safe(r.get("Lote_max", r.get("Tamaño lote máximo", 1)), 1)
+    extremos = [int(dias.min()), int(dias.max()) + 31] if len(dias) else []
+    if "restante" in libro:
+        extremos += [libro["dia0"], libro["dia0"] + libro["restante"].shape[1] - 1]
+    dia_ini, dia_fin = (min(extremos), max(extremos)) if extremos else (0, 31)
+    if (calendario is None or calendario.empty or not set(centros_cal) <= set(calendario.columns)
+            or int(calendario["Dia"].iat[0]) > dia_ini or int(calendario["Dia"].iat[-1]) < dia_fin):
+        if calendario is not None and not calendario.empty:
+            dia_ini = min(dia_ini, int(calendario["Dia"].iat[0]))
+            dia_fin = max(dia_fin, int(calendario["Dia"].iat[-1]))
+        calendario = construir_calendario(dia_ini, dia_fin, centros_cal, **atributos)
+    cargar_horizonte(calendario)
+
+    def dia_con_capacidad(centro, dia):
+        """Primer día con capacidad restante del centro en o después de `dia`."""
+        while True:
+            i = dia - cal["dia0"]
+            if i < cal["n"]:
+                sig, j = cal["sig"][centro], i
+                while j < cal["n"] and sig[j] != j:
+                    j = sig[j]
+                k = i
+                while k < j and k < cal["n"]:
+                    sig[k], k = j, sig[k]
+                if j < cal["n"]:
+                    return cal["dia0"] + j
+            fin_perfil = max((h for c, _, h, _ in atributos.get("perfil", []) if c == centro), default=None)
+            if capacidades.get(centro, 0) <= 0 and (fin_perfil is None or fin_perfil < cal["dia0"] + cal["n"]):
+                raise ValueError(f"El centro {centro} no tiene capacidad a partir del {texto_de_dia(dia)}.")
+            cargar_horizonte(construir_calendario(
+                cal["dia0"], cal["dia0"] + 2 * max(cal["n"], i + 1), centros_cal, **atributos
+            ))
+
+    for material, unidad, centro, fecha, cantidad, lote_min, lote_max, tu, necesidad in filas:
+        fecha = dia_con_capacidad(centro, fecha)
+        semana = cal["semana"][fecha - cal["dia0"]]
 
         total = max(cantidad, lote_min)
         lote_max = max(1.0, lote_max)
@@ -296,49 +1165,887 @@ def modo_C(df_agr, df_mat, capacidades, DG_code, MCH_code):
             p = ql
             while p > 0:
                 cap = get_cap(centro, fecha)
-                hnec = horas_nec(centro, p, r)
+                hnec = horas_nec(p, tu)
 
                 if cap >= hnec:
                     consume(centro, fecha, hnec)
                     out.append({
                         "Nº de propuesta": contador,
-                        "Material": r["Material"],
+                        "Material": material,
                         "Centro": centro,
                         "Clase de orden": "NORM",
                         "Cantidad a fabricar": round(p,2),
-                        "Unidad": r["Unidad"],
-                        "Fecha": fecha.strftime("%d.%m.%Y"),
+                        "Unidad": unidad,
+                        "Fecha": cal["texto"][fecha - cal["dia0"]],
                         "Semana": semana,          # (se usa internamente)
                         "Lote_min": lote_min,
-                        "Lote_max": lote_max
+                        "Lote_max": lote_max,
+                        "Necesidad": necesidad,
+                        "Dia": fecha
                     })
                     contador += 1
                     p = 0
                 else:
-                    posible = cant_por_cap(centro, cap, r)
+                    posible = cant_por_cap(cap, tu)
                     if posible <= 0:
-                        fecha += timedelta(days=1)
-                        semana = semana_iso_str_from_ts(fecha)
+                        fecha = dia_con_capacidad(centro, fecha + 1)
+                        semana = cal["semana"][fecha - cal["dia0"]]
                         continue
 
-                    hprod = horas_nec(centro, posible, r)
+                    hprod = horas_nec(posible, tu)
                     consume(centro, fecha, hprod)
                     out.append({
                         "Nº de propuesta": contador,
-                        "Material": r["Material"],
+                        "Material": material,
                         "Centro": centro,
                         "Clase de orden": "NORM",
                         "Cantidad a fabricar": round(posible,2),
-                        "Unidad": r["Unidad"],
-                        "Fecha": fecha.strftime("%d.%m.%Y"),
+                        "Unidad": unidad,
+                        "Fecha": cal["texto"][fecha - cal["dia0"]],
                         "Semana": semana,
                         "Lote_min": lote_min,
-                        "Lote_max": lote_max
+                        "Lote_max": lote_max,
+                        "Necesidad": necesidad,
+                        "Dia": fecha
                     })
                     contador += 1
                     p -= posible
 
-    return pd.DataFrame(out)
+    res = pd.DataFrame(out)
+    if res.empty:
+        return res
+    # Claves de salida codificadas: mismo diccionario que la entrada
+    for c in ("Material", "Unidad"):
+        if isinstance(df[c].dtype, pd.CategoricalDtype):
+            res[c] = pd.Categorical(res[c], dtype=df[c].dtype)
+    for c in ("Centro", "Semana"):
+        res[c] = res[c].astype("category")
+    return res
+
+# ------------------------------------------------------------
+# CARGA DE MAESTROS (lectura en paralelo)
+# ------------------------------------------------------------
+MAESTROS = {
+    "df_cap": {"titulo": "🏭 Capacidad de planta", "nombre": "Capacidad", "key": "u1", "tipos": ["xlsx"],
+               "etiqueta": "Subir Capacidad (Capacidad horas por Centro)", "guardar": "Capacidad planta",
+               "log": "upload_capacidad", "alto": 150,
+               "hojas": {"capacidad", "capacidades", "capacidad planta"}},
+    "df_mat": {"titulo": "📦 Maestro de materiales", "nombre": "Materiales", "key": "u2", "tipos": ["xlsx"],
+               "etiqueta": "Subir Materiales", "guardar": "Maestro materiales",
+               "log": "upload_materiales", "alto": 400,
+               "hojas": {"materiales", "maestro materiales", "material"}},
+    "df_cli": {"titulo": "👥 Maestro de clientes", "nombre": "Clientes", "key": "u3", "tipos": ["xlsx"],
+               "etiqueta": "Subir Clientes", "guardar": "Maestro clientes",
+               "log": "upload_clientes", "alto": 400,
+               "hojas": {"clientes", "maestro clientes", "cliente"}},
+    "df_dem": {"titulo": "📈 Demanda", "nombre": "Demanda", "key": "u4", "tipos": ["xlsx", "csv"],
+               "etiqueta": "Subir Demanda", "guardar": "Demanda",
+               "log": "upload_demanda", "alto": 400,
+               "hojas": {"demanda", "demandas"}},
+}
+
+# Qué hacer si un maestro repite una clave con datos distintos
+POLITICAS_DUPLICADOS = ["Conservar primero", "Conservar último", "Detener"]
+
+def claves_maestro(clave, df):
+    """Columnas que deben ser únicas en cada maestro que se cruza con la demanda."""
+    if clave == "df_mat":
+        return ["Material", "Unidad"]
+    if clave == "df_cli":
+        col = detectar_columna_cliente(df)
+        return [col] if col else []
+    return []
+
+def indexar_maestro(df, claves, politica=POLITICAS_DUPLICADOS[0]):
+    """
+    Deja el maestro con una fila por clave. Las filas repetidas idénticas se quitan sin más;
+    las claves con datos distintos (conflictos) se resuelven según la política, o lanzan
+    ValueError con «Detener». Devuelve (maestro único, filas en conflicto).
+    """
+    if not claves or not set(claves) <= set(df.columns):
+        return df, df.iloc[:0]
+    repetidas = df.duplicated(claves, keep=False)
+    if not repetidas.any():
+        return df, df.iloc[:0]
+
+    distintas = df[repetidas].drop_duplicates()
+    conflictos = distintas[distintas.duplicated(claves, keep=False)].sort_values(claves, kind="stable")
+    if len(conflictos) and politica == "Detener":
+        ejemplos = conflictos[claves].drop_duplicates().head(3).astype(str).agg(" / ".join, axis=1)
+        raise ValueError(
+            f"{conflictos[claves].drop_duplicates().shape[0]} claves ({', '.join(claves)}) con datos distintos, "
+            f"p. ej. {', '.join(ejemplos)}."
+        )
+    keep = "last" if politica == "Conservar último" else "first"
+    return df.drop_duplicates(claves, keep=keep).reset_index(drop=True), conflictos
+
+def indice_claves(df, claves):
+    """Índice clave → posición de fila (MultiIndex si la clave tiene varias columnas)."""
+    return pd.MultiIndex.from_frame(df[claves]) if len(claves) > 1 else pd.Index(df[claves[0]])
+
+def cruzar_columnas(df, claves_df, maestro, claves_maestro, columnas):
+    """
+    Cruce «left» uno a uno sin merge: cada fila de `df` localiza su clave en el índice
+    del maestro y recibe solo `columnas` (NaN si la clave no está). El maestro debe ser
+    único en su clave (indexar_maestro); si no, ValueError.
+    """
+    indice = indice_claves(maestro, claves_maestro)
+    if not indice.is_unique:
+        raise ValueError(f"Clave ({', '.join(claves_maestro)}) repetida en el maestro: el cruce multiplicaría filas.")
+    pos = indice.get_indexer(indice_claves(df, claves_df))
+    traidas = maestro[columnas].reset_index(drop=True).reindex(pos)
+    traidas.index = df.index
+    return pd.concat([df, traidas], axis=1)
+
+def parsear_maestro(clave, archivo, politica=POLITICAS_DUPLICADOS[0], staging=None):
+    """
+    Lee y normaliza un maestro subido. Se ejecuta en un hilo del pool (sin llamadas a st).
+    Con `staging` (ruta .db) la Demanda se agrega en SQLite (agregar_demanda_en_sqlite).
+    Devuelve (df, líneas leídas por bloques, filas en conflicto, informe de validar_hoja
+    sobre el archivo original, segundos).
+    """
+    t0 = time.perf_counter()
+    lineas_csv = None
+    if clave == "df_dem" and staging:
+        df, lineas_csv, incidencias = agregar_demanda_en_sqlite(archivo, staging)
+    elif clave == "df_dem" and archivo.name.lower().endswith(".csv"):
+        # Exportación ERP grande: lectura por bloques ya agregada
+        df, lineas_csv, incidencias = leer_demanda_csv_por_bloques(archivo)
+    else:
+        df = pd.read_excel(archivo)
+        incidencias = validar_hoja(clave, df)
+    df = codificar_claves(df)
+    if clave == "df_dem":
+        df = normalizar_fechas_demanda(df, descartar_invalidas=True)
+    df, conflictos = indexar_maestro(df, claves_maestro(clave, df), politica)
+    return df, lineas_csv, conflictos, incidencias, time.perf_counter() - t0
+
+def _hoja_es(clave, df):
+    """Reconoce el maestro de una hoja por sus columnas características."""
+    cols = {str(c).strip() for c in df.columns}
+    if clave == "df_cap":
+        return {"Centro", "Capacidad horas"} <= cols
+    if clave == "df_mat":
+        return {"Material", "Unidad"} <= cols and any("tiempo" in c.lower() for c in cols)
+    if clave == "df_dem":
+        return {"Material", "Fecha de necesidad", "Cantidad"} <= cols
+    return "Material" not in cols and detectar_columna_cliente(df) is not None
+
+def asignar_hojas(hojas):
+    """{nombre de hoja: df} → {clave de maestro: nombre de hoja}; primero por nombre, luego por columnas."""
+    libres = list(hojas)
+    asignadas = {}
+    for clave, cfg in MAESTROS.items():
+        nombre = next((h for h in libres if h.strip().lower() in cfg["hojas"]), None)
+        if nombre is not None:
+            asignadas[clave] = nombre
+            libres.remove(nombre)
+    for clave in MAESTROS:
+        if clave in asignadas:
+            continue
+        nombre = next((h for h in libres if _hoja_es(clave, hojas[h])), None)
+        if nombre is not None:
+            asignadas[clave] = nombre
+            libres.remove(nombre)
+    return asignadas
+
+def parsear_libro(archivo, politica=POLITICAS_DUPLICADOS[0]):
+    """
+    Lee todas las hojas de un libro en una sola pasada (un único read_excel con
+    sheet_name=None: el zip se abre y descomprime una vez) y las asigna a los maestros.
+    Devuelve ({clave: df}, {clave: hoja}, {clave: filas en conflicto},
+    {clave: informe de validar_hoja sobre la hoja}, segundos).
+    """
+    t0 = time.perf_counter()
+    hojas = pd.read_excel(archivo, sheet_name=None)
+    asignadas = asignar_hojas(hojas)
+    incidencias = {clave: validar_hoja(clave, hojas[nombre]) for clave, nombre in asignadas.items()}
+    dfs = {clave: codificar_claves(hojas[nombre]) for clave, nombre in asignadas.items()}
+    if "df_dem" in dfs:
+        dfs["df_dem"] = normalizar_fechas_demanda(dfs["df_dem"], descartar_invalidas=True)
+    conflictos = {}
+    for clave, df in dfs.items():
+        dfs[clave], conflictos[clave] = indexar_maestro(df, claves_maestro(clave, df), politica)
+    return dfs, asignadas, conflictos, incidencias, time.perf_counter() - t0
+
+def mostrar_maestro(hueco, clave):
+    """Estado, tiempo de lectura y vista previa de un maestro ya cargado."""
+    cfg = MAESTROS[clave]
+    info = st.session_state.get("cargas", {}).get(clave, {})
+    df = st.session_state[clave]
+    with hueco.container():
+        st.success(f"✅ Cargado en {info.get('segundos', 0):.2f}s")
+        if info.get("hoja"):
+            st.caption(f"Hoja «{info['hoja']}» del libro único.")
+        if info.get("archivo_erp"):
+            st.caption(f"Leído por el vigilante de la carpeta «{ENTRADA_DIR}»: {info['archivo_erp']}.")
+        if info.get("staging"):
+            st.caption(f"Demanda agregada en disco (SQLite): {info['lineas_csv']:,} líneas → {len(df):,} claves en memoria.".replace(",", "."))
+        elif info.get("lineas_csv") is not None:
+            st.caption(f"CSV leído por bloques: {info['lineas_csv']:,} líneas → {len(df):,} claves agregadas.".replace(",", "."))
+        conflictos = info.get("conflictos")
+        if conflictos is not None and len(conflictos):
+            st.warning(f"⚠️ {len(conflictos)} filas con clave repetida y datos distintos; se aplicó «{info.get('politica')}».")
+            with st.expander("Ver conflictos"):
+                st.dataframe(conflictos, use_container_width=True)
+        st.dataframe(df, use_container_width=True, height=cfg["alto"])
+        if clave == "df_cap":
+            st.caption("Lee exactamente la columna **Capacidad horas** por **Centro** (ej.: 0833=40, 0184=20).")
+
+# ------------------------------------------------------------
+# VALIDACIÓN DE ENTRADAS (por columnas, antes de planificar)
+# ------------------------------------------------------------
+COLUMNAS_INFORME = ["Gravedad", "Tabla", "Fila", "Columna", "Valor", "Problema"]
+INFORME_FILAS_VISIBLES = 1000
+
+def _incidencias(tabla, mascara, columna, valores, problema, gravedad="Error"):
+    """
+    Filas marcadas en `mascara` → bloque del informe. La fila es la de la hoja original
+    (cabecera = 1) y sale del índice: read_excel y read_csv por trozos numeran desde 0.
+    """
+    pos = np.flatnonzero(mascara)
+    if not len(pos):
+        return None
+    v = valores.iloc[pos] if isinstance(valores, pd.Series) else pd.Series(valores).iloc[pos]
+    return pd.DataFrame({
+        "Gravedad": gravedad, "Tabla": tabla, "Fila": np.asarray(v.index) + 2, "Columna": columna,
+        "Valor": v.astype(object).where(v.notna(), "").astype(str).to_numpy(), "Problema": problema,
+    })
+
+def _incidencias_por_clave(tabla, mascara, columna, valores, problema, gravedad="Error"):
+    """Claves distintas marcadas en `mascara`, sin fila (tras agregar, una clave resume varias líneas)."""
+    v = pd.Series(valores)[np.asarray(mascara, dtype=bool)]
+    if not len(v):
+        return None
+    v = v.astype(object).where(v.notna(), "").astype(str).drop_duplicates()
+    return pd.DataFrame({"Gravedad": gravedad, "Tabla": tabla, "Fila": None, "Columna": columna,
+                         "Valor": v.to_numpy(), "Problema": problema})
+
+def _falta_columna(tabla, columna):
+    return pd.DataFrame([{"Gravedad": "Error", "Tabla": tabla, "Fila": None, "Columna": columna,
+                          "Valor": "", "Problema": "Falta la columna"}])
+
+def _informe(partes):
+    partes = [p for p in partes if p is not None and len(p)]
+    if not partes:
+        return pd.DataFrame(columns=COLUMNAS_INFORME)
+    informe = pd.concat(partes, ignore_index=True)
+    informe["Fila"] = informe["Fila"].astype("Int64")
+    return informe[COLUMNAS_INFORME]
+
+def _numero(s):
+    """(valores float con NaN si no hay número, vacíos, no numéricos) de una columna."""
+    vals = to_float_safe_col(s, np.nan).to_numpy()
+    s = pd.Series(s)
+    vacio = s.isna().to_numpy()
+    if not pd.api.types.is_numeric_dtype(s):
+        vacio = vacio | s.astype(str).str.strip().eq("").to_numpy()
+    return vals, vacio, np.isnan(vals) & ~vacio
+
+def validar_hoja(clave, df):
+    """
+    Comprobaciones celda a celda de un maestro tal como llega: la hoja leída o cada bloque
+    del CSV, antes de convertir cantidades, agregar la demanda o quitar duplicados. Así
+    un «abc» o un negativo no desaparecen en una suma y la fila es la del archivo.
+    """
+    df = df.rename(columns=lambda c: str(c).strip())
+    tabla = MAESTROS[clave]["nombre"]
+    partes = []
+
+    def numericas(col, negativo=True, cero=None, vacio="Error"):
+        if col not in df.columns:
+            partes.append(_falta_columna(tabla, col))
+            return
+        vals, nulo, malo = _numero(df[col])
+        partes.append(_incidencias(tabla, nulo, col, df[col], "Vacío", vacio))
+        partes.append(_incidencias(tabla, malo, col, df[col], "No es un número"))
+        if negativo:
+            partes.append(_incidencias(tabla, vals < 0, col, df[col], "Negativo"))
+        if cero:
+            partes.append(_incidencias(tabla, vals == 0, col, df[col], *cero))
+
+    def fechas(col, vacia_es_error):
+        valores = df[col]
+        malas = np.isnan(dias_o_nulos(valores))
+        if not vacia_es_error:
+            malas &= valores.notna().to_numpy()
+        partes.append(_incidencias(tabla, malas, col, valores, "Fecha no válida"))
+
+    if clave == "df_cap":
+        # Centro, horas y fechas de las filas con fecha
+        if "Centro" not in df.columns:
+            partes.append(_falta_columna(tabla, "Centro"))
+        else:
+            partes.append(_incidencias(tabla, norm_code_col(df["Centro"]).eq("").to_numpy()
+                                       | df["Centro"].isna().to_numpy(), "Centro", df["Centro"], "Centro vacío"))
+        numericas(_columna_capacidad(df) or "Capacidad horas")
+        desde, hasta = _columnas_fecha_capacidad(df)
+        for col in dict.fromkeys(c for c in (desde, hasta) if c):
+            fechas(col, vacia_es_error=False)
+    elif clave == "df_mat":
+        # Tiempos por centro y tamaños de lote
+        for col in ("Material", "Unidad"):
+            if col not in df.columns:
+                partes.append(_falta_columna(tabla, col))
+        for col in ("Tiempo fabricación unidad DG", "Tiempo fabricación unidad MCH"):
+            numericas(col, cero=("Tiempo cero: no consume capacidad", "Aviso"))
+        numericas("Tamaño lote mínimo", vacio="Aviso")
+        numericas("Tamaño lote máximo", cero=("Lote máximo cero", "Error"))
+    elif clave == "df_cli":
+        col_cli = detectar_columna_cliente(df)
+        if not col_cli:
+            partes.append(_falta_columna(tabla, "Cliente"))
+        else:
+            partes.append(_incidencias(tabla, df[col_cli].isna().to_numpy(), col_cli, df[col_cli], "Cliente vacío", "Aviso"))
+    else:
+        # Demanda: cantidad y fecha de cada línea
+        numericas("Cantidad")
+        if "Fecha de necesidad" in df.columns:
+            fechas("Fecha de necesidad", vacia_es_error=True)
+        elif "Dia" not in df.columns:
+            partes.append(_falta_columna(tabla, "Fecha de necesidad"))
+    return _informe(partes)
+
+def validar_entradas(df_cap, df_mat, df_cli, df_dem, crudas=None):
+    """
+    Informe de incidencias de los cuatro maestros (por columnas, sin recorrer filas):
+    una fila por celda con problema. Las comprobaciones por celda vienen de la carga
+    (`crudas`: {clave: validar_hoja sobre el archivo original}); un maestro sin ellas se
+    revisa aquí tal como está. Después, las claves de la demanda contra los maestros.
+    «Error» impide planificar; «Aviso» se muestra pero no bloquea.
+    """
+    crudas = crudas or {}
+    dfs = {"df_cap": df_cap, "df_mat": df_mat, "df_cli": df_cli, "df_dem": df_dem}
+    partes = [crudas[c] if crudas.get(c) is not None else validar_hoja(c, df) for c, df in dfs.items()]
+
+    # Demanda contra los maestros: por clave distinta
+    claves = ["Material", "Unidad"]
+    if not set(claves) <= set(df_dem.columns):
+        partes += [_falta_columna("Demanda", c) for c in claves if c not in df_dem.columns]
+    elif set(claves) <= set(df_mat.columns):
+        desconocido = ~indice_claves(df_dem, claves).isin(indice_claves(df_mat, claves))
+        if desconocido.any():
+            texto = df_dem["Material"].astype(str) + " / " + df_dem["Unidad"].astype(str)
+            partes.append(_incidencias_por_clave("Demanda", desconocido, "Material / Unidad", texto, "No está en Materiales"))
+    col_cli_cli = detectar_columna_cliente(df_cli)
+    col_cli_dem = detectar_columna_cliente(df_dem)
+    if not col_cli_dem:
+        partes.append(_falta_columna("Demanda", "Cliente"))
+    elif col_cli_cli:
+        desconocido = ~df_dem[col_cli_dem].isin(df_cli[col_cli_cli]).to_numpy()
+        partes.append(_incidencias_por_clave("Demanda", desconocido, col_cli_dem, df_dem[col_cli_dem],
+                                             "No está en Clientes", "Aviso"))
+    if "Centro" in df_dem.columns and "Centro" in df_cap.columns:
+        centros = norm_code_col(df_dem["Centro"])
+        desconocido = ~centros.isin(set(norm_code_col(df_cap["Centro"]))).to_numpy()
+        partes.append(_incidencias_por_clave("Demanda", desconocido, "Centro", df_dem["Centro"], "Centro sin capacidad"))
+    return _informe(partes)
+
+def mostrar_validacion(informe):
+    """Resumen del informe de validación; devuelve True si hay errores que bloquean."""
+    errores = informe["Gravedad"].eq("Error")
+    if not len(informe):
+        st.caption("✅ Datos de entrada validados: sin incidencias.")
+        return False
+    resumen = informe.groupby(["Gravedad", "Tabla", "Problema"], sort=False).size().rename("Filas").reset_index()
+    if errores.any():
+        st.error(f"❌ {int(errores.sum()):,} errores en los datos de entrada. Corrígelos para poder planificar.".replace(",", "."))
+    else:
+        st.warning(f"⚠️ {len(informe):,} avisos en los datos de entrada (no impiden planificar).".replace(",", "."))
+    with st.expander("Ver informe de validación", expanded=bool(errores.any())):
+        st.dataframe(resumen, use_container_width=True, hide_index=True)
+        st.dataframe(informe.head(INFORME_FILAS_VISIBLES), use_container_width=True, hide_index=True)
+        if len(informe) > INFORME_FILAS_VISIBLES:
+            st.caption(f"Se muestran {INFORME_FILAS_VISIBLES} de {len(informe):,} incidencias; descarga el informe completo.".replace(",", "."))
+        st.download_button("Descargar informe (CSV)", informe.to_csv(index=False, sep=";").encode("utf-8-sig"),
+                           file_name="Informe_validacion.csv", mime="text/csv")
+    return bool(errores.any())
+
+# ------------------------------------------------------------
+# PLAN INICIAL (sin st: errores como ValueError)
+# ------------------------------------------------------------
+def preparar_demanda_base(df_cap, df_mat, df_cli, df_dem, politica=POLITICAS_DUPLICADOS[0]):
+    """Demanda agrupada por Material/Unidad/Centro/Día lista para modo_C."""
+    capacidades = leer_capacidades(df_cap)
+    DG_code, MCH_code, _ = detectar_centros_desde_capacidades(capacidades)
+
+    # Día entero (normalizado en la ingesta)
+    df_dem = normalizar_fechas_demanda(df_dem) if "Dia" not in df_dem.columns else df_dem
+
+    # Merge con maestros
+    col_cli_dem = detectar_columna_cliente(df_dem)
+    col_cli_cli = detectar_columna_cliente(df_cli)
+    if not col_cli_dem or not col_cli_cli:
+        raise ValueError("No se encontró la columna de cliente en Demanda o Clientes.")
+
+    # Demanda reducida a las claves que se usan: los cruces trabajan sobre
+    # una fila por Material/Unidad/Cliente/Día en vez de una por línea
+    t0 = time.perf_counter()
+    claves_dem = ["Material", "Unidad", col_cli_dem, "Dia"]
+    df_red = df_dem.groupby(claves_dem, dropna=False, observed=True, sort=False)["Cantidad"].sum().reset_index()
+    registrar_metrica("preagregar_demanda", segundos=round(time.perf_counter() - t0, 4),
+                      filas_entrada=len(df_dem), filas_salida=len(df_red))
+
+    # Semana ISO calculada por día distinto
+    dias_u, inv = np.unique(df_red["Dia"].to_numpy(), return_inverse=True)
+    df_red["Semana_Label"] = pd.Categorical(np.array([semana_de_dia(d) for d in dias_u], dtype=object)[inv])
+
+    # Maestros únicos en su clave: cada cruce es uno a uno (sin multiplicar la demanda)
+    df_mat, _ = indexar_maestro(df_mat, ["Material", "Unidad"], politica)
+    df_cli, _ = indexar_maestro(df_cli, [col_cli_cli], politica)
+
+    # Solo las columnas que se leen después (costes por centro y tamaños de lote),
+    # traídas por índice clave → fila en lugar de merge con el maestro entero
+    es_coste = lambda c, centro: centro in c.lower() and "cost" in c.lower()
+    COL_COST_DG = next((c for c in df_mat.columns if es_coste(c, "dg")), None)
+    COL_COST_MCH = next((c for c in df_mat.columns if es_coste(c, "mch")), None)
+    cols_mat = [c for c in ["Tamaño lote mínimo", "Tamaño lote máximo", COL_COST_DG, COL_COST_MCH]
+                if c in df_mat.columns and c not in df_red.columns]
+    df = cruzar_columnas(df_red, ["Material", "Unidad"], df_mat, ["Material", "Unidad"], list(dict.fromkeys(cols_mat)))
+    registrar_metrica("cruce_materiales", filas_entrada=len(df_red), filas_salida=len(df),
+                      **medida_cruce(df_red, df_mat, ["Material", "Unidad"], df))
+
+    # Clientes solo aporta algo si trae columnas de coste (las de materiales mandan)
+    COL_COST_DG = COL_COST_DG or next((c for c in df_cli.columns if es_coste(c, "dg")), None)
+    COL_COST_MCH = COL_COST_MCH or next((c for c in df_cli.columns if es_coste(c, "mch")), None)
+    cols_cli = [c for c in [COL_COST_DG, COL_COST_MCH] if c in df_cli.columns and c not in df.columns]
+    if cols_cli:
+        df_izq = df
+        df = cruzar_columnas(df, [col_cli_dem], df_cli, [col_cli_cli], list(dict.fromkeys(cols_cli)))
+        registrar_metrica("cruce_clientes", filas_entrada=len(df_izq), filas_salida=len(df),
+                          **medida_cruce(df_izq, df_cli, [col_cli_cli], df))
+
+    # Decisión por coste (conversión por columna, mismo resultado que to_float_safe por fila)
+    coste = lambda col: to_float_safe_col(df[col]).to_numpy() if col else np.zeros(len(df))
+    df["Centro_Base"] = pd.Categorical(np.where(coste(COL_COST_DG) < coste(COL_COST_MCH), DG_code, MCH_code))
+
+    # Agrupar demanda base (sobre códigos de categoría)
+    t0 = time.perf_counter()
+    g = df.groupby(
+        ["Material","Unidad","Centro_Base","Dia","Semana_Label"], dropna=False, observed=True
+    ).agg({
+        "Cantidad":"sum",
+        "Tamaño lote mínimo":"first",
+        "Tamaño lote máximo":"first"
+    }).reset_index()
+    registrar_metrica("agrupar_demanda", segundos=round(time.perf_counter() - t0, 4), filas=len(df), grupos=len(g))
+
+    g = g.rename(columns={
+        "Centro_Base":"Centro",
+        "Semana_Label":"Semana"
+    })
+    g["Centro"] = norm_code_col(g["Centro"]).astype("category")
+    g["Lote_min"] = g["Tamaño lote mínimo"]
+    g["Lote_max"] = g["Tamaño lote máximo"]
+    return g[["Material","Unidad","Centro","Cantidad","Dia","Semana","Lote_min","Lote_max"]], capacidades, DG_code, MCH_code
+
+def calcular_horas(df_c, df_mat, DG_code):
+    tiempos = df_mat.drop_duplicates(["Material","Unidad"])
+    df_c = cruzar_columnas(df_c, ["Material","Unidad"], tiempos, ["Material","Unidad"],
+                           ["Tiempo fabricación unidad DG","Tiempo fabricación unidad MCH"])
+    df_c["Horas"] = np.where(
+        df_c["Centro"] == DG_code,
+        df_c["Cantidad a fabricar"] * df_c["Tiempo fabricación unidad DG"],
+        df_c["Cantidad a fabricar"] * df_c["Tiempo fabricación unidad MCH"]
+    )
+    return df_c
+
+def ejecutar_modoC_base(df_cap, df_mat, df_cli, df_dem, politica=POLITICAS_DUPLICADOS[0]):
+    """Plan inicial completo. No usa st: lo llaman la pestaña de ejecución y el vigilante de carpeta."""
+    g, capacidades, DG_code, MCH_code = preparar_demanda_base(df_cap, df_mat, df_cli, df_dem, politica)
+
+    # Calendario del horizonte (se reutiliza en reajustes y deltas)
+    calendario = construir_calendario(
+        g["Dia"].min(), g["Dia"].max() + 31, list(capacidades),
+        festivos=leer_festivos(df_cap), perfil=leer_perfil_capacidad(df_cap)
+    )
+
+    # Propuestas (planificador por lotes con capacidad); el libro de capacidad
+    # consumida se conserva para las actualizaciones incrementales
+    libro = {}
+    df_c = modo_C(
+        df_agr=g,
+        df_mat=df_mat,
+        capacidades=capacidades,
+        DG_code=DG_code, MCH_code=MCH_code,
+        capacidad_restante=libro,
+        calendario=calendario
+    )
+    df_c = calcular_horas(df_c, df_mat, DG_code)
+
+    return df_c, capacidades, DG_code, MCH_code, g, libro, calendario
+
+# ------------------------------------------------------------
+# CARPETA DE ENTRADA DEL ERP (vigilante en segundo plano)
+# ------------------------------------------------------------
+ENTRADA_DIR = "entrada_erp"   # junto a archivos_cargados; el ERP deja aquí sus exportaciones
+VIGILANTE_SEGUNDOS = 30
+PLAN_PRECALCULADO = os.path.join(UPLOAD_DIR, "plan_precalculado.pkl")
+PLAN_PRECALCULADO_INFO = os.path.join(UPLOAD_DIR, "plan_precalculado.json")
+INFORME_CARPETA = os.path.join(UPLOAD_DIR, "Informe_validacion_entrada_erp.csv")
+# Claves de session_state del plan, en el orden en que las devuelve ejecutar_modoC_base
+CLAVES_PLAN = ["df_base", "capacidades", "DG", "MCH", "g_base", "libro_base", "calendario"]
+
+def firma_carpeta(carpeta):
+    """{archivo: [mtime_ns, tamaño]} de los xlsx/CSV de la carpeta (sin temporales de Excel)."""
+    firma = {}
+    for nombre in sorted(os.listdir(carpeta)):
+        ruta = os.path.join(carpeta, nombre)
+        if nombre.lower().endswith((".xlsx", ".csv")) and not nombre.startswith("~$") and os.path.isfile(ruta):
+            info = os.stat(ruta)
+            firma[nombre] = [info.st_mtime_ns, info.st_size]
+    return firma
+
+def leer_info_precalculado():
+    """Resumen del último plan precalculado (JSON pequeño; no carga el plan)."""
+    try:
+        with open(PLAN_PRECALCULADO_INFO, encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def _guardar_atomico(ruta, escribir):
+    tmp = ruta + ".tmp"
+    with open(tmp, "wb") as f:
+        escribir(f)
+    os.replace(tmp, ruta)   # quien lee ve el archivo anterior o el nuevo, nunca uno a medias
+
+def leer_maestros_carpeta(carpeta, firma, politica=POLITICAS_DUPLICADOS[0]):
+    """
+    Maestros presentes en la carpeta, reconocidos por hoja/columnas (xlsx) o como
+    Demanda (CSV). Si dos archivos traen el mismo maestro, gana el más reciente.
+    Devuelve ({clave: df}, {clave: archivo}, {clave: informe de validar_hoja}).
+    """
+    dfs, origen, incidencias = {}, {}, {}
+    for nombre in sorted(firma, key=lambda n: firma[n][0]):
+        with open(os.path.join(carpeta, nombre), "rb") as f:
+            archivo = io.BytesIO(f.read())
+        archivo.name = nombre
+        if nombre.lower().endswith(".csv"):
+            df, _, _, informe, _ = parsear_maestro("df_dem", archivo, politica)
+            hojas, informes = {"df_dem": df}, {"df_dem": informe}
+        else:
+            hojas, _, _, informes, _ = parsear_libro(archivo, politica)
+        for clave, df in hojas.items():
+            df.columns = df.columns.astype(str).str.strip()
+            dfs[clave], origen[clave], incidencias[clave] = df, nombre, informes[clave]
+    return dfs, origen, incidencias
+
+def precalcular_plan(carpeta, firma):
+    """
+    Lee, valida y planifica lo que hay en la carpeta; guarda el plan (pickle) y su
+    resumen (JSON) en UPLOAD_DIR. Con errores de validación solo guarda el informe.
+    """
+    t0 = time.perf_counter()
+    info = {"firma": firma, "creado": datetime.now().isoformat(timespec="seconds")}
+    _metricas_hilo.lista = metricas = []
+    try:
+        dfs, origen, incidencias = leer_maestros_carpeta(carpeta, firma)
+        info["archivos"] = {MAESTROS[c]["nombre"]: n for c, n in origen.items()}
+        faltan = [MAESTROS[c]["nombre"] for c in MAESTROS if c not in dfs]
+        if faltan:
+            info.update(estado="incompleto", mensaje="Faltan en la carpeta: " + ", ".join(faltan))
+        else:
+            informe = validar_entradas(dfs["df_cap"], dfs["df_mat"], dfs["df_cli"], dfs["df_dem"], crudas=incidencias)
+            if informe["Gravedad"].eq("Error").any():
+                informe.to_csv(INFORME_CARPETA, index=False, sep=";", encoding="utf-8-sig")
+                info.update(estado="errores", mensaje=f"{int(informe['Gravedad'].eq('Error').sum())} errores de validación")
+            else:
+                plan = dict(zip(CLAVES_PLAN, ejecutar_modoC_base(dfs["df_cap"], dfs["df_mat"], dfs["df_cli"], dfs["df_dem"])))
+                datos = {**dfs, **plan, "origen": origen, "incidencias": incidencias, "metricas": metricas, "creado": info["creado"]}
+                _guardar_atomico(PLAN_PRECALCULADO, lambda f: pickle.dump(datos, f, protocol=pickle.HIGHEST_PROTOCOL))
+                info.update(estado="ok", propuestas=int(len(plan["df_base"])), avisos=int(len(informe)))
+    except Exception as e:
+        info.update(estado="fallo", mensaje=str(e))
+    finally:
+        _metricas_hilo.lista = None
+    info["segundos"] = round(time.perf_counter() - t0, 3)
+    _guardar_atomico(PLAN_PRECALCULADO_INFO, lambda f: f.write(_safe_json(info).encode("utf-8")))
+    log_event("plan_precalculado", details={"carpeta": carpeta, "archivos": info.get("archivos")},
+              results={k: v for k, v in info.items() if k not in ("firma", "archivos")},
+              user="vigilante_erp", session_id="vigilante_erp")
+    return info
+
+def revisar_carpeta(carpeta, estado):
+    """
+    Una vuelta del vigilante. Solo se planifica cuando la carpeta ha cambiado y lleva
+    una vuelta sin cambiar (el ERP ha terminado de escribir).
+    """
+    os.makedirs(carpeta, exist_ok=True)
+    firma = firma_carpeta(carpeta)
+    estado["ultima_revision"] = datetime.now().isoformat(timespec="seconds")
+    if firma != estado.get("vista"):
+        estado["vista"] = firma
+        return None
+    if not firma or firma == estado.get("procesada"):
+        return None
+    estado["procesada"] = firma
+    return precalcular_plan(carpeta, firma)
+
+def _vigilar(carpeta, estado):
+    while True:
+        try:
+            revisar_carpeta(carpeta, estado)
+            estado["error"] = None
+        except Exception as e:
+            estado["error"] = str(e)
+        time.sleep(VIGILANTE_SEGUNDOS)
+
+@st.cache_resource
+def iniciar_vigilante(carpeta=ENTRADA_DIR):
+    """Un solo hilo por proceso (compartido por todas las sesiones) vigila la carpeta del ERP."""
+    os.makedirs(carpeta, exist_ok=True)
+    # Tras reiniciar el servidor no se repite el plan de una carpeta que no ha cambiado
+    procesada = leer_info_precalculado().get("firma")
+    estado = {"carpeta": carpeta, "vista": procesada, "procesada": procesada, "ultima_revision": None, "error": None}
+    threading.Thread(target=_vigilar, args=(carpeta, estado), daemon=True, name="vigilante_erp").start()
+    return estado
+
+@st.cache_data(max_entries=1, show_spinner=False)
+def cargar_plan_precalculado(ruta, creado):
+    """Plan precalculado (se deserializa una vez por versión; cada sesión recibe su copia)."""
+    with open(ruta, "rb") as f:
+        return pickle.load(f)
+
+# ------------------------------------------------------------
+# EXPORTACIÓN DE PROPUESTAS (xlsx en streaming; CSV si es muy grande)
+# ------------------------------------------------------------
+EXPORT_FILAS_BLOQUE = 20_000       # filas que se convierten a tipos Python de una vez
+EXPORT_MAX_FILAS_EXCEL = 100_000   # por encima se exporta CSV (openpyxl escribe ~8k filas/s; más con lxml)
+COLUMNAS_PROPUESTA = ["Nº de propuesta", "Material", "Centro", "Clase de orden", "Cantidad a fabricar", "Unidad", "Fecha"]
+# Carga masiva al ERP: columnas en orden fijo, Fecha AAAAMMDD (como david.py)
+ERP_COLUMNAS = ["Nº de propuesta", "Material", "Centro", "Clase de orden", "Cantidad a fabricar", "Unidad", "Fecha"]
+ERP_SEPARADOR = ";"
+ERP_DECIMAL = ","
+ERP_CODIFICACION = "utf-8"
+
+def filas_exportacion(df, filas_bloque=EXPORT_FILAS_BLOQUE):
+    """Filas de df como tuplas de tipos Python, por bloques (nulos -> celda vacía)."""
+    for i in range(0, len(df), filas_bloque):
+        bloque = df.iloc[i:i + filas_bloque]
+        columnas = [bloque[c].astype(object).where(bloque[c].notna(), None).tolist() for c in bloque.columns]
+        yield from zip(*columnas)
+
+def escribir_xlsx_streaming(df, ruta, hoja="Propuestas"):
+    """xlsx con openpyxl en modo write_only: las filas van al disco según se añaden."""
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet(hoja)
+    ws.append([str(c) for c in df.columns])
+    for fila in filas_exportacion(df):
+        ws.append(fila)
+    wb.save(ruta)
+
+def memoria_residente_mb():
+    """Memoria residente del proceso en MB (None si el sistema no expone /proc)."""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2**20
+    except (OSError, ValueError, AttributeError):
+        return None
+
+def medir_pico_memoria(funcion, intervalo=0.02):
+    """
+    Ejecuta funcion() y devuelve el pico de memoria residente por encima de la inicial (MB).
+    Se muestrea desde otro hilo: tracemalloc multiplicaba por 5 el tiempo de openpyxl.
+    """
+    base = memoria_residente_mb()
+    if base is None:
+        funcion()
+        return None
+    pico, fin = [base], threading.Event()
+    def muestrear():
+        while not fin.wait(intervalo):
+            pico[0] = max(pico[0], memoria_residente_mb())
+    hilo = threading.Thread(target=muestrear, daemon=True)
+    hilo.start()
+    try:
+        funcion()
+    finally:
+        fin.set()
+        hilo.join()
+    return round(max(pico[0], memoria_residente_mb()) - base, 1)
+
+def formato_exportacion(filas):
+    return "xlsx" if filas <= EXPORT_MAX_FILAS_EXCEL else "csv"
+
+def exportar_propuestas(df):
+    """
+    Propuestas como bytes de un .xlsx (o .csv si superan EXPORT_MAX_FILAS_EXCEL), sin
+    pasar por disco. Devuelve (bytes, formato) y anota tiempo y pico de memoria.
+    """
+    formato = formato_exportacion(len(df))
+    salida = io.BytesIO()
+    def escribir():
+        if formato == "xlsx":
+            escribir_xlsx_streaming(df, salida)
+        else:
+            df.to_csv(salida, sep=";", index=False, encoding="utf-8-sig", chunksize=EXPORT_FILAS_BLOQUE)
+    t0 = time.perf_counter()
+    pico = medir_pico_memoria(escribir)
+    datos = salida.getvalue()
+    registrar_metrica(f"exportar_{formato}", segundos=round(time.perf_counter() - t0, 3), filas=int(len(df)),
+                      pico_mb=pico, archivo_mb=round(len(datos) / 2**20, 1))
+    return datos, formato
+
+def huella_df(df):
+    """Huella del contenido (filas y nombres de columna) de un DataFrame."""
+    h = hashlib.blake2b(digest_size=16)
+    h.update("|".join(map(str, df.columns)).encode("utf-8"))
+    h.update(pd.util.hash_pandas_object(df, index=False).to_numpy().tobytes())
+    return f"{len(df)}-{h.hexdigest()}"
+
+def huella_en_sesion(clave, df, columnas):
+    """Huella de df[columnas], recalculada solo cuando el plan de la sesión es otro objeto."""
+    memo = st.session_state.setdefault("huellas_exportacion", {})
+    guardado = memo.get(clave)
+    if guardado is None or guardado[0] is not df or guardado[1] != columnas:
+        guardado = memo[clave] = (df, list(columnas), huella_df(df[columnas]))
+    return guardado[2]
+
+def bloques_erp(df, filas_bloque=EXPORT_FILAS_BLOQUE):
+    """Texto del formato ERP (sin cabecera) por bloques de filas: el texto se convierte por tramos, no de golpe."""
+    for i in range(0, len(df), filas_bloque):
+        bloque = df.iloc[i:i + filas_bloque]
+        dias = bloque["Dia"].to_numpy() if "Dia" in bloque.columns else fechas_a_dias(bloque["Fecha"])
+        unicos, pos = np.unique(dias, return_inverse=True)   # pocas fechas distintas: un strftime por fecha
+        salida = bloque[ERP_COLUMNAS].copy()
+        salida["Fecha"] = dias_a_fechas(unicos).strftime("%Y%m%d").to_numpy()[pos]
+        yield salida.to_csv(sep=ERP_SEPARADOR, decimal=ERP_DECIMAL, header=False, index=False, lineterminator="\n")
+
+def exportar_erp(df, filas_por_archivo=None):
+    """
+    Propuestas en el formato de carga masiva al ERP, como bytes: un CSV o, con
+    filas_por_archivo, un zip de partes de ese tamaño (cada una con su cabecera).
+    Se convierte por bloques, pero el archivo completo queda en memoria (~37 B/fila).
+    """
+    cabecera = (ERP_SEPARADOR.join(ERP_COLUMNAS) + "\n").encode(ERP_CODIFICACION)
+    salida = io.BytesIO()
+    partes = range(0, max(len(df), 1), filas_por_archivo) if filas_por_archivo else [0]
+    def escribir():
+        if not filas_por_archivo:
+            salida.write(cabecera)
+            for texto in bloques_erp(df):
+                salida.write(texto.encode(ERP_CODIFICACION))
+            return
+        with zipfile.ZipFile(salida, "w", zipfile.ZIP_DEFLATED) as zf:
+            for n, i in enumerate(partes, start=1):
+                with zf.open(f"propuestas_erp_{n:03d}.csv", "w") as f:
+                    f.write(cabecera)
+                    for texto in bloques_erp(df.iloc[i:i + filas_por_archivo]):
+                        f.write(texto.encode(ERP_CODIFICACION))
+    t0 = time.perf_counter()
+    pico = medir_pico_memoria(escribir)
+    datos = salida.getvalue()
+    registrar_metrica("exportar_erp", segundos=round(time.perf_counter() - t0, 3), filas=int(len(df)),
+                      archivos=len(partes), pico_mb=pico, archivo_mb=round(len(datos) / 2**20, 1))
+    return datos
+
+# Cada entrada es un archivo completo en memoria (≈3,7 MB por 100.000 filas en xlsx o
+# CSV ERP): pocas entradas y caducidad para no acumular exportaciones en el proceso
+EXPORT_CACHE_ENTRADAS = 3
+EXPORT_CACHE_TTL = "30m"
+
+@st.cache_data(max_entries=EXPORT_CACHE_ENTRADAS, ttl=EXPORT_CACHE_TTL, show_spinner=False)
+def exportacion_cacheada(huella, formato, _df, filas_por_archivo=None):
+    """Bytes de la exportación por (huella, formato, partes): se reutilizan hasta que cambia el plan."""
+    if formato == "erp":
+        return exportar_erp(_df, filas_por_archivo)
+    return exportar_propuestas(_df)[0]
+
+def _descarga_en_hilo(accion, detalles, resultados, producir):
+    """
+    Envuelve producir() (→ bytes) para el hilo de descarga de Streamlit, que no tiene
+    contexto de sesión: métricas a la lista de la sesión y usuario explícito en el log.
+    """
+    metricas = st.session_state.setdefault("metricas", [])
+    usuario, sesion = get_user(), get_session_id()
+    def generar():
+        _metricas_hilo.lista = metricas
+        try:
+            datos = producir()
+        finally:
+            _metricas_hilo.lista = None
+        try:
+            log_event(accion, details=detalles, results={**resultados, "bytes": len(datos)}, user=usuario, session_id=sesion)
+        except Exception:
+            pass
+        return datos
+    return generar
+
+def descarga_diferida(df, columnas, huella, detalles, formato=None, filas_por_archivo=None):
+    """
+    Callable para st.download_button: la exportación se genera (o se toma de la caché)
+    solo cuando el usuario pulsa Descargar.
+    """
+    formato = formato or formato_exportacion(len(df))
+    return _descarga_en_hilo(
+        "export_erp" if formato == "erp" else "export_excel",
+        {**detalles, "formato": formato, "huella": huella, "filas_por_archivo": filas_por_archivo},
+        {"rows": int(len(df))},
+        lambda: exportacion_cacheada(huella, formato, df[columnas], filas_por_archivo)
+    )
+
+def _miembro_en_hilo(nombre, serializar, metricas):
+    _metricas_hilo.lista = metricas
+    try:
+        return nombre, serializar()
+    finally:
+        _metricas_hilo.lista = None
+
+def exportar_paquete(miembros):
+    """
+    Zip en memoria con {nombre_archivo: función → bytes}. Cada miembro se genera entero
+    (son las mismas entradas de caché que las descargas sueltas), en paralelo, y se añade
+    al zip según termina; los xlsx (ya comprimidos) se guardan tal cual. El pico de memoria
+    es, por tanto, los miembros en curso más el zip.
+    """
+    metricas = getattr(_metricas_hilo, "lista", None)
+    salida = io.BytesIO()
+    t0 = time.perf_counter()
+    with zipfile.ZipFile(salida, "w", zipfile.ZIP_DEFLATED) as zf, \
+            ThreadPoolExecutor(max_workers=min(4, len(miembros))) as pool:
+        futuros = [pool.submit(_miembro_en_hilo, n, f, metricas) for n, f in miembros.items()]
+        for fut in as_completed(futuros):
+            nombre, datos = fut.result()
+            zf.writestr(nombre, datos, compress_type=zipfile.ZIP_STORED if nombre.endswith((".xlsx", ".zip")) else None)
+    datos = salida.getvalue()
+    registrar_metrica("exportar_paquete", segundos=round(time.perf_counter() - t0, 3), archivos=len(miembros),
+                      archivo_mb=round(len(datos) / 2**20, 1))
+    return datos
+
+@st.cache_data(max_entries=4, show_spinner=False)
+def paquete_cacheado(huella, _miembros):
+    """Bytes del paquete por huella (planes + ajustes): se reutilizan hasta que cambia algo."""
+    return exportar_paquete(_miembros)
+
+def _csv_carga_semanal(carga):
+    return carga.round(2).to_csv(sep=";", decimal=",").encode("utf-8-sig")
+
+def descarga_paquete(df_base, df_final, ajustes, DG, MCH):
+    """
+    Callable para st.download_button con el paquete completo: propuesta inicial, replan
+    (si la hay), carga semanal de cada una y los ajustes usados. Sin generar nada hasta pulsar.
+    """
+    orden = [str(DG), str(MCH)]
+    def carga(df):
+        c = carga_semanal(df)
+        return c.reindex(columns=[x for x in orden if x in c.columns])
+    planes = [("Propuesta Inicial", df_base)] + ([("Propuesta Replan", df_final)] if df_final is not None else [])
+    huellas, miembros = {}, {}
+    for nombre, df in planes:
+        cols = [c for c in COLUMNAS_PROPUESTA if c in df.columns]
+        formato = formato_exportacion(len(df))
+        h = huellas[nombre] = huella_en_sesion(nombre, df, cols)
+        # Mismas entradas de caché que las descargas sueltas: si ya se bajó el Excel, no se rehace
+        miembros[f"{nombre}.{formato}"] = lambda h=h, f=formato, df=df, cols=cols: exportacion_cacheada(h, f, df[cols])
+        miembros[f"Carga semanal {nombre.split()[-1].lower()}.csv"] = lambda df=df: _csv_carga_semanal(carga(df))
+    resumen = {"DG": DG, "MCH": MCH, "ajustes": ajustes if df_final is not None else None, "huellas": huellas,
+               "generado": datetime.now().isoformat(timespec="seconds")}
+    miembros["ajustes.json"] = lambda: json.dumps(resumen, ensure_ascii=False, indent=2, default=str).encode("utf-8")
+    huella = hashlib.blake2b(_safe_json({"huellas": huellas, "ajustes": resumen["ajustes"]}).encode("utf-8"),
+                             digest_size=16).hexdigest()
+    return _descarga_en_hilo("export_paquete", {"archivos": list(miembros), "huella": huella},
+                             {"planes": len(planes)}, lambda: paquete_cacheado(huella, miembros))
 
 # ------------------------------------------------------------
 # ENCABEZADO — Título y subtítulo centrados en la página
@@ -359,6 +2066,31 @@ st.markdown(
 )
 st.markdown("---")
 
+# ------------------------------------------------------------
+# PLAN PRECALCULADO DESDE LA CARPETA DEL ERP
+# ------------------------------------------------------------
+vigilante = iniciar_vigilante()
+info_erp = leer_info_precalculado()
+sin_datos = all(st.session_state.get(c) is None for c in MAESTROS)
+if (info_erp.get("estado") == "ok" and os.path.exists(PLAN_PRECALCULADO)
+        and (sin_datos or st.session_state.get("origen_datos") == "carpeta")
+        and st.session_state.get("plan_erp") != info_erp["creado"]):
+    # Sesión sin datos propios: se sirve el último plan de la carpeta sin recalcular
+    datos_erp = cargar_plan_precalculado(PLAN_PRECALCULADO, info_erp["creado"])
+    cargas = st.session_state.setdefault("cargas", {})
+    for clave in MAESTROS:
+        st.session_state[clave] = datos_erp[clave]
+        cargas[clave] = {"id": f"erp:{datos_erp['creado']}:{clave}", "segundos": 0, "lineas_csv": None,
+                         "archivo_erp": datos_erp["origen"][clave],
+                         "incidencias": datos_erp.get("incidencias", {}).get(clave)}
+    for clave in CLAVES_PLAN:
+        st.session_state[clave] = datos_erp[clave]
+    st.session_state.calculo_realizado = True
+    st.session_state.df_final_reajuste = None
+    st.session_state.setdefault("metricas", []).extend(datos_erp["metricas"])
+    st.session_state.origen_datos = "carpeta"
+    st.session_state.plan_erp = info_erp["creado"]
+
 # ============================================================
 # TABS
 # ============================================================
@@ -372,127 +2104,274 @@ df_cap = df_mat = df_cli = df_dem = None
 # =========================
 with tab1:
     st.subheader("📁 Carga tus archivos Excel")
-
-    col1, col2 = st.columns(2)
-
-    # Capacidad
-    with col1:
-        st.markdown('<div class="section-container">', unsafe_allow_html=True)
-        st.markdown("### 🏭 Capacidad de planta")
-        f1 = st.file_uploader("Subir Capacidad (Capacidad horas por Centro)", type=["xlsx"], key="u1", label_visibility="collapsed")
-        if f1:
+    # Estado de la carpeta del ERP (el vigilante la revisa en segundo plano)
+    estado_erp = {"ok": "plan listo", "incompleto": "incompleta", "errores": "con errores", "fallo": "fallo al planificar"}
+    texto_erp = f"📂 Carpeta «{ENTRADA_DIR}» vigilada cada {VIGILANTE_SEGUNDOS} s"
+    if vigilante.get("ultima_revision"):
+        texto_erp += f" · última revisión {vigilante['ultima_revision']}"
+    if info_erp.get("creado"):
+        texto_erp += f" · último proceso {info_erp['creado']}: {estado_erp.get(info_erp.get('estado'), '—')}"
+    st.caption(texto_erp)
+    if info_erp.get("estado") in ("incompleto", "errores", "fallo"):
+        detalle = f" Informe: {INFORME_CARPETA}" if info_erp["estado"] == "errores" else ""
+        st.warning(f"📂 {info_erp.get('mensaje', '')}.{detalle}")
+    if vigilante.get("error"):
+        st.warning(f"📂 El vigilante no puede leer la carpeta: {vigilante['error']}")
+    politica = st.radio(
+        "Si Materiales o Clientes repiten una clave con datos distintos",
+        POLITICAS_DUPLICADOS, horizontal=True, key="politica_duplicados",
+        help="Se aplica al cargar los maestros y de nuevo al ejecutar el cálculo."
+    )
+    staging = st.checkbox(
+        "💽 Demanda muy grande: agregar en disco (SQLite)", key="staging_sqlite",
+        help="Las líneas de Demanda (CSV o xlsx, leídas por bloques) se vuelcan a una base SQLite temporal; "
+             "la agregación por Material/Unidad/Cliente/Día la hace SQLite y solo el resultado queda en memoria."
+    )
+
+    # Libro único con las cuatro hojas (alternativa a las cuatro subidas)
+    st.markdown("#### 📚 Libro único (Capacidad, Materiales, Clientes y Demanda)")
+    libro = st.file_uploader(
+        "Subir un libro con las cuatro hojas", type=["xlsx"], key="u0", label_visibility="collapsed"
+    )
+    cargas = st.session_state.setdefault("cargas", {})
+    if libro is not None and st.session_state.get("libro_id") != libro.file_id:
+        with st.spinner("Leyendo libro…"):
             try:
-                df_cap = pd.read_excel(f1)
-                path1 = guardar_archivo(f1, "Capacidad planta")
-                st.session_state.df_cap = df_cap.copy()
-                st.success("✅ Cargado")
-                st.dataframe(df_cap, use_container_width=True, height=150)
-                st.caption("Lee exactamente la columna **Capacidad horas** por **Centro** (ej.: 0833=40, 0184=20).")
-
-                # 🔹 LOG
-                log_event(
-                    "upload_capacidad",
-                    details={
-                        "file_name": getattr(f1, "name", "capacidad.xlsx"),
-                        "saved_as": path1,
-                        "rows": int(len(df_cap)),
-                        "cols": list(map(str, df_cap.columns))
-                    }
-                )
+                dfs_libro, hojas_libro, conflictos_libro, incidencias_libro, seg_libro = parsear_libro(libro, politica)
             except Exception as e:
-                st.error(f"Error al leer Capacidad: {e}")
-        else:
-            st.info("Esperando archivo…")
-        st.markdown('</div>', unsafe_allow_html=True)
-
-    # Materiales
-    with col2:
-        st.markdown('<div class="section-container">', unsafe_allow_html=True)
-        st.markdown("### 📦 Maestro de materiales")
-        f2 = st.file_uploader("Subir Materiales", type=["xlsx"], key="u2", label_visibility="collapsed")
-        if f2:
-            try:
-                df_mat = pd.read_excel(f2)
-                path2 = guardar_archivo(f2, "Maestro materiales")
-                st.session_state.df_mat = df_mat.copy()
-                st.success("✅ Cargado")
-                st.dataframe(df_mat, use_container_width=True, height=400)
-
-                # 🔹 LOG
+                st.error(f"Error al leer el libro: {e}")
+            else:
+                path = guardar_archivo(libro, "Libro maestros")
+                for clave, df_hoja in dfs_libro.items():
+                    st.session_state[clave] = df_hoja
+                    cargas[clave] = {"id": f"{libro.file_id}:{clave}", "segundos": seg_libro,
+                                     "lineas_csv": None, "hoja": hojas_libro[clave],
+                                     "conflictos": conflictos_libro[clave], "politica": politica,
+                                     "incidencias": incidencias_libro[clave]}
+                st.session_state["libro_id"] = libro.file_id
+                st.session_state.origen_datos = "manual"
+                registrar_metrica("carga_libro", segundos=round(seg_libro, 4), hojas=len(dfs_libro))
                 log_event(
-                    "upload_materiales",
+                    "upload_libro",
                     details={
-                        "file_name": getattr(f2, "name", "materiales.xlsx"),
-                        "saved_as": path2,
-                        "rows": int(len(df_mat)),
-                        "cols": list(map(str, df_mat.columns))
+                        "file_name": getattr(libro, "name", "libro"),
+                        "saved_as": path,
+                        "hojas": {MAESTROS[c]["nombre"]: h for c, h in hojas_libro.items()},
+                        "rows": {MAESTROS[c]["nombre"]: int(len(d)) for c, d in dfs_libro.items()},
+                        "segundos": round(seg_libro, 3)
                     }
                 )
-            except Exception as e:
-                st.error(f"Error al leer Materiales: {e}")
-        else:
-            st.info("Esperando archivo…")
-        st.markdown('</div>', unsafe_allow_html=True)
+                sin_hoja = [MAESTROS[c]["nombre"] for c in MAESTROS if c not in dfs_libro]
+                if sin_hoja:
+                    st.warning("⚠️ No se encontró hoja para: " + ", ".join(sin_hoja) + ". Súbelos por separado.")
+    if libro is not None and st.session_state.get("libro_id") == libro.file_id:
+        st.caption("Libro leído en una sola pasada; una subida individual sustituye la hoja correspondiente.")
 
+    col1, col2 = st.columns(2)
     col3, col4 = st.columns(2)
+    huecos = {}
+    archivos = {}
+
+    for clave, col in zip(MAESTROS, [col1, col2, col3, col4]):
+        cfg = MAESTROS[clave]
+        with col:
+            st.markdown('<div class="section-container">', unsafe_allow_html=True)
+            st.markdown(f"### {cfg['titulo']}")
+            archivos[clave] = st.file_uploader(
+                cfg["etiqueta"], type=cfg["tipos"], key=cfg["key"], label_visibility="collapsed"
+            )
+            huecos[clave] = st.empty()
+            st.markdown('</div>', unsafe_allow_html=True)
+
+    # Solo se leen los archivos nuevos; el resto ya está en la sesión
+    nuevos = {
+        clave: f for clave, f in archivos.items()
+        if f is not None and cargas.get(clave, {}).get("id") != f.file_id
+    }
+    for clave in nuevos:
+        huecos[clave].info("⏳ Leyendo…")
+
+    # Lectura y normalización de los maestros nuevos en paralelo
+    if nuevos:
+        t_ini = time.perf_counter()
+        # Base de trabajo temporal de la carga (agregar_demanda_en_sqlite la borra al terminar)
+        ruta_staging = os.path.join(UPLOAD_DIR, f"staging_demanda_{get_session_id()}.db") if staging else None
+        with ThreadPoolExecutor(max_workers=len(nuevos)) as pool:
+            futuros = {
+                pool.submit(parsear_maestro, clave, f, politica, ruta_staging if clave == "df_dem" else None): clave
+                for clave, f in nuevos.items()
+            }
+            for fut in as_completed(futuros):
+                clave = futuros[fut]
+                f = nuevos[clave]
+                cfg = MAESTROS[clave]
+                try:
+                    df_nuevo, lineas_csv, conflictos, incidencias, segundos = fut.result()
+                except Exception as e:
+                    huecos[clave].error(f"Error al leer {cfg['nombre']}: {e}")
+                    continue
 
-    # Clientes
-    with col3:
-        st.markdown('<div class="section-container">', unsafe_allow_html=True)
-        st.markdown("### 👥 Maestro de clientes")
-        f3 = st.file_uploader("Subir Clientes", type=["xlsx"], key="u3", label_visibility="collapsed")
-        if f3:
-            try:
-                df_cli = pd.read_excel(f3)
-                path3 = guardar_archivo(f3, "Maestro clientes")
-                st.session_state.df_cli = df_cli.copy()
-                st.success("✅ Cargado")
-                st.dataframe(df_cli, use_container_width=True, height=400)
+                path = guardar_archivo(f, cfg["guardar"])
+                st.session_state[clave] = df_nuevo
+                st.session_state.origen_datos = "manual"
+                cargas[clave] = {"id": f.file_id, "segundos": segundos, "lineas_csv": lineas_csv,
+                                 "conflictos": conflictos, "politica": politica, "incidencias": incidencias,
+                                 "staging": ruta_staging if clave == "df_dem" else None}
+                mostrar_maestro(huecos[clave], clave)
 
                 # 🔹 LOG
                 log_event(
-                    "upload_clientes",
+                    cfg["log"],
                     details={
-                        "file_name": getattr(f3, "name", "clientes.xlsx"),
-                        "saved_as": path3,
-                        "rows": int(len(df_cli)),
-                        "cols": list(map(str, df_cli.columns))
+                        "file_name": getattr(f, "name", cfg["guardar"]),
+                        "saved_as": path,
+                        "rows": int(len(df_nuevo)),
+                        "lineas_csv": lineas_csv,
+                        "segundos": round(segundos, 3),
+                        "conflictos": int(len(conflictos)),
+                        "cols": list(map(str, df_nuevo.columns))
                     }
                 )
-            except Exception as e:
-                st.error(f"Error al leer Clientes: {e}")
-        else:
-            st.info("Esperando archivo…")
-        st.markdown('</div>', unsafe_allow_html=True)
-
-    # Demanda
-    with col4:
-        st.markdown('<div class="section-container">', unsafe_allow_html=True)
-        st.markdown("### 📈 Demanda")
-        f4 = st.file_uploader("Subir Demanda", type=["xlsx"], key="u4", label_visibility="collapsed")
-        if f4:
-            try:
-                df_dem = pd.read_excel(f4)
-                path4 = guardar_archivo(f4, "Demanda")
-                st.session_state.df_dem = df_dem.copy()
-                st.success("✅ Cargado")
-                st.dataframe(df_dem, use_container_width=True, height=400)
+        t_total = time.perf_counter() - t_ini
+        suma = sum(cargas[c]["segundos"] for c in nuevos if c in cargas)
+        registrar_metrica("carga_maestros", segundos=round(t_total, 4), suma_secuencial=round(suma, 4), archivos=len(nuevos))
+        st.caption(f"Archivos listos en {t_total:.2f}s (lectura por separado: {suma:.2f}s).")
+
+    for clave, f in archivos.items():
+        if f is None:
+            if libro is not None and cargas.get(clave, {}).get("id") == f"{libro.file_id}:{clave}":
+                mostrar_maestro(huecos[clave], clave)
+            elif cargas.get(clave, {}).get("archivo_erp") and st.session_state.get(clave) is not None:
+                mostrar_maestro(huecos[clave], clave)
+            else:
+                huecos[clave].info("Esperando archivo…")
+        elif clave not in nuevos and cargas.get(clave, {}).get("id") == f.file_id:
+            mostrar_maestro(huecos[clave], clave)
 
-                # 🔹 LOG
-                log_event(
-                    "upload_demanda",
-                    details={
-                        "file_name": getattr(f4, "name", "demanda.xlsx"),
-                        "saved_as": path4,
-                        "rows": int(len(df_dem)),
-                        "cols": list(map(str, df_dem.columns))
-                    }
-                )
-            except Exception as e:
-                st.error(f"Error al leer Demanda: {e}")
+# =========================
+# TAB 3 — HISTORIAL (se ejecuta antes que TAB 2, que hace st.stop() si faltan archivos)
+# =========================
+with tab3:
+    st.subheader("🧾 Historial de acciones")
+    try:
+        # Sin espera en cada rerun (las pestañas se ejecutan todas): el escritor suele ir
+        # al día; solo al pulsar se espera, poco, a lo que quede en cola
+        if st.button("🔄 Actualizar", help="Incluye las acciones recién registradas que aún se están guardando"):
+            vaciar_auditoria(espera=1.0)
+            valores_historial.clear()
+
+        # Filtros (se aplican en SQL, sobre todo el historial)
+        colf1, colf2, colf3, colf4 = st.columns([1, 1, 1, 1.3])
+        with colf1:
+            f_user = st.selectbox("Usuario", ["(todos)"] + valores_historial("user"), index=0)
+        with colf2:
+            f_action = st.selectbox("Acción", ["(todas)"] + valores_historial("action"), index=0)
+        with colf3:
+            f_sesion = st.text_input("Session ID", help="Todas las acciones de una sesión").strip()
+        with colf4:
+            f_fechas = st.date_input("Fechas (desde – hasta)", value=(), format="DD.MM.YYYY")
+        filtro = filtro_historial(
+            usuario=None if f_user == "(todos)" else f_user,
+            accion=None if f_action == "(todas)" else f_action,
+            sesion=f_sesion or None,
+            desde=f_fechas[0] if len(f_fechas) > 0 else None,
+            hasta=f_fechas[-1] if len(f_fechas) > 0 else None,
+        )
+
+        # Paginación por clave: se guarda el id de corte de cada página visitada
+        if st.session_state.get("historial_filtro") != filtro:
+            st.session_state.historial_filtro = filtro
+            st.session_state.historial_cortes = [None]
+        cortes = st.session_state.historial_cortes
+        t0 = time.perf_counter()
+        df_logs, hay_mas = pagina_historial(filtro, cortes[-1])
+        ms = (time.perf_counter() - t0) * 1000
+
+        st.dataframe(df_logs, use_container_width=True, height=420)
+        colp1, colp2, colp3 = st.columns([1, 2, 1])
+        with colp1:
+            if st.button("⬅ Más recientes", disabled=len(cortes) == 1, use_container_width=True):
+                cortes.pop()
+                st.rerun()
+        with colp2:
+            st.caption(f"Página {len(cortes)} · {len(df_logs)} acciones · consulta en {ms:,.1f} ms")
+        with colp3:
+            if st.button("Más antiguas ➡", disabled=not hay_mas, use_container_width=True):
+                cortes.append(int(df_logs["id"].iloc[-1]))
+                st.rerun()
+
+        # Exportar historial filtrado a CSV (todas las páginas; se genera al pulsar)
+        st.download_button(
+            "📥 Descargar historial filtrado (CSV)",
+            data=lambda: csv_historial(filtro),
+            file_name=f"historial_{datetime.now().strftime('%Y%m%d_%H%M%S')}.csv",
+            mime="text/csv",
+            on_click="ignore"
+        )
+
+        # Planes guardados: se recargan desde su instantánea, sin subir archivos ni recalcular
+        st.markdown("#### 📂 Planes guardados")
+        with _get_conn() as conn:
+            df_planes = pd.read_sql_query(
+                "SELECT p.log_id, l.ts, l.user, l.action, p.filas, p.bytes FROM planes p "
+                "JOIN logs l ON l.id = p.log_id ORDER BY p.log_id DESC LIMIT 200",
+                conn
+            )
+        if df_planes.empty:
+            st.caption("Aún no hay planes guardados: se guardan al ejecutar el cálculo y al re‑planificar.")
         else:
-            st.info("Esperando archivo…")
-        st.markdown('</div>', unsafe_allow_html=True)
+            opciones = {
+                f"#{r.log_id} · {r.ts[:19].replace('T', ' ')} · {r.action} · {r.user} · {r.filas:,} propuestas".replace(",", "."): r.log_id
+                for r in df_planes.itertuples()
+            }
+            elegido = st.selectbox("Plan", list(opciones), key="plan_guardado")
+            if st.button("Cargar plan", key="cargar_plan_guardado"):
+                t0 = time.perf_counter()
+                df_hist = cargar_plan_guardado(opciones[elegido])
+                seg = time.perf_counter() - t0
+                registrar_metrica("cargar_plan_guardado", segundos=round(seg, 4), filas=len(df_hist))
+                st.session_state.plan_guardado_cargado = {"log_id": opciones[elegido], "df": df_hist, "segundos": seg}
+
+            cargado = st.session_state.get("plan_guardado_cargado")
+            if cargado is not None:
+                df_hist = cargado["df"]
+                st.caption(f"Plan #{cargado['log_id']} cargado en {cargado['segundos'] * 1000:,.0f} ms.")
+                horas_hist = df_hist.groupby("Centro", observed=True)["Horas"].sum() if "Horas" in df_hist.columns else pd.Series(dtype=float)
+                mh = st.columns(1 + len(horas_hist))
+                mh[0].metric("Total Propuestas", f"{len(df_hist):,}".replace(",", "."))
+                for k, (centro, horas) in enumerate(horas_hist.items(), start=1):
+                    mh[k].metric(f"Horas totales {centro}", f"{horas:,.1f}h".replace(",", "."))
+                if {"Semana", "Centro", "Horas"} <= set(df_hist.columns):
+                    st.bar_chart(carga_semanal(df_hist), use_container_width=True)
+                cols_hist = [c for c in COLUMNAS_PROPUESTA if c in df_hist.columns]
+                st.dataframe(df_hist[cols_hist], use_container_width=True, height=320)
+                nombre_hist = f"Plan historial {cargado['log_id']}"
+                formato_hist = formato_exportacion(len(df_hist))
+                st.download_button(
+                    f"📥 Descargar plan #{cargado['log_id']} ({'Excel' if formato_hist == 'xlsx' else 'CSV'})",
+                    data=descarga_diferida(df_hist, cols_hist, huella_en_sesion(nombre_hist, df_hist, cols_hist),
+                                           {"nombre_descarga": nombre_hist, "log_id": cargado["log_id"], "columnas": cols_hist}),
+                    file_name=f"{nombre_hist}.{formato_hist}",
+                    on_click="ignore"
+                )
+
+        # Mantenimiento opcional: borrar logs antiguos
+        with st.expander("🧹 Mantenimiento (opcional)"):
+            dias = st.slider("Borrar logs anteriores a (días)", 30, 365, 90)
+            if st.button("Borrar logs antiguos"):
+                try:
+                    limite = (datetime.now() - timedelta(days=dias)).isoformat()
+                    with _get_conn() as conn:
+                        c = conn.cursor()
+                        c.execute("DELETE FROM logs WHERE ts < ?", (limite,))
+                        c.execute("DELETE FROM planes WHERE log_id NOT IN (SELECT id FROM logs)")
+                        conn.commit()
+                    st.success("Hecho. Recarga para ver el resultado.")
+                except Exception as e:
+                    st.error(f"No se pudieron borrar logs: {e}")
+
+    except Exception as e:
+        st.info(f"No se pudo cargar el historial: {e}")
 
 # =========================
 # TAB 2 — EJECUCIÓN + REAJUSTE
@@ -513,85 +2392,83 @@ with tab2:
         d.columns = d.columns.str.strip()
 
     # -----------------------------
-    # Generación inicial (usa el planificador por lotes)
+    # Actualización incremental: solo centros/fechas afectados por el delta
     # -----------------------------
-    def ejecutar_modoC_base(df_cap, df_mat, df_cli, df_dem):
-        capacidades = leer_capacidades(df_cap)
-        DG_code, MCH_code, _ = detectar_centros_desde_capacidades(capacidades)
-
-        # Fechas y semana ISO
-        df_dem = df_dem.copy()
-        df_dem["Fecha_DT"] = pd.to_datetime(df_dem["Fecha de necesidad"])
-        iso = df_dem["Fecha_DT"].dt.isocalendar()
-        df_dem["Semana_Label"] = iso["year"].astype(str) + "-W" + iso["week"].astype(str).str.zfill(2)
-
-        # Merge con maestros
-        col_cli_dem = detectar_columna_cliente(df_dem)
-        col_cli_cli = detectar_columna_cliente(df_cli)
-        if not col_cli_dem or not col_cli_cli:
-            st.error("❌ No se encontró la columna de cliente en Demanda o Clientes.")
-            st.stop()
-
-        df = df_dem.merge(df_mat, on=["Material", "Unidad"], how="left")
-        df = df.merge(df_cli, left_on=col_cli_dem, right_on=col_cli_cli, how="left")
-
-        # Decisión por coste
-        COL_COST_DG = next((c for c in df.columns if "dg" in c.lower() and "cost" in c.lower()), None)
-        COL_COST_MCH = next((c for c in df.columns if "mch" in c.lower() and "cost" in c.lower()), None)
-
-        def decidir_centro(r):
-            c1 = to_float_safe(r.get(COL_COST_DG, 0))
-            c2 = to_float_safe(r.get(COL_COST_MCH, 0))
-            return DG_code if c1 < c2 else MCH_code
-
-        df["Centro_Base"] = df.apply(decidir_centro, axis=1)
-
-        # Agrupar demanda base
-        g = df.groupby(
-            ["Material","Unidad","Centro_Base","Fecha de necesidad","Semana_Label"], dropna=False
-        ).agg({
-            "Cantidad":"sum",
-            "Tamaño lote mínimo":"first",
-            "Tamaño lote máximo":"first"
-        }).reset_index()
-
-        g = g.rename(columns={
-            "Centro_Base":"Centro",
-            "Fecha de necesidad":"Fecha",
-            "Semana_Label":"Semana"
-        })
-        g["Centro"] = g["Centro"].apply(norm_code)
-        g["Lote_min"] = g["Tamaño lote mínimo"]
-        g["Lote_max"] = g["Tamaño lote máximo"]
-
-        # Propuestas (planificador por lotes con capacidad)
-        df_c = modo_C(
-            df_agr=g[["Material","Unidad","Centro","Cantidad","Fecha","Semana","Lote_min","Lote_max"]],
-            df_mat=df_mat,
-            capacidades=capacidades,
-            DG_code=DG_code, MCH_code=MCH_code
+    def replanificar_delta(g_old, g_new, df_base, libro, df_mat, capacidades, DG_code, MCH_code, calendario=None):
+        """
+        Replanifica, por centro, desde la primera fecha cuya demanda agrupada cambia.
+        Las propuestas anteriores a esa fecha (y las de centros sin cambios) se reutilizan,
+        y el libro de capacidad se recorta a lo ya consumido antes de ella.
+        """
+        claves = ["Material","Unidad","Centro","Dia"]
+        valores = ["Cantidad","Lote_min","Lote_max"]
+
+        def normalizar(g):
+            d = g[claves + valores].copy()
+            for c in ["Material","Unidad","Centro"]:
+                d[c] = d[c].astype(object)
+            for c in valores:
+                d[c] = to_float_safe_col(d[c], 0)
+            return d
+
+        comp = normalizar(g_old).merge(normalizar(g_new), on=claves, how="outer", suffixes=("_old","_new"), indicator=True)
+        distinto = (comp["_merge"] != "both").to_numpy(copy=True)
+        for c in valores:
+            distinto |= ~np.isclose(comp[c + "_old"], comp[c + "_new"], equal_nan=True)
+        inicio = comp.loc[distinto].groupby("Centro")["Dia"].min().to_dict()
+        if not inicio:
+            return df_base, libro, {"centros": {}, "reutilizadas": int(len(df_base)), "recalculadas": 0}
+
+        centros_prop = df_base["Centro"].astype(object)
+        d0_prop = centros_prop.map(inicio)
+        afectada = (d0_prop.notna() & (df_base["Dia"] >= d0_prop)).to_numpy()
+        conservadas = df_base.loc[~afectada]
+
+        # Lo que la demanda anterior a d0 desbordó más allá de d0 se vuelve a colocar desde d0
+        desbordes = df_base.loc[afectada & (df_base["Necesidad"] < d0_prop).to_numpy()]
+        resto = (
+            desbordes.groupby(["Material","Unidad","Centro","Necesidad","Semana"], observed=True, sort=False)
+            .agg(Cantidad=("Cantidad a fabricar","sum"), Lote_max=("Lote_max","first"))
+            .reset_index()
         )
+        resto["Dia"] = resto["Centro"].astype(object).map(inicio)
+        resto["Lote_min"] = 0.0
+
+        g_new = g_new.assign(Necesidad=g_new["Dia"])
+        d0_dem = g_new["Centro"].astype(object).map(inicio)
+        nuevas = g_new.loc[(d0_dem.notna() & (g_new["Necesidad"] >= d0_dem)).to_numpy()]
 
-        # Calcular horas
-        tiempos = df_mat[["Material","Unidad","Tiempo fabricación unidad DG","Tiempo fabricación unidad MCH"]].drop_duplicates()
-        df_c = df_c.merge(tiempos, on=["Material","Unidad"], how="left")
-        df_c["Horas"] = np.where(
-            df_c["Centro"].astype(str) == str(DG_code),
-            df_c["Cantidad a fabricar"] * df_c["Tiempo fabricación unidad DG"],
-            df_c["Cantidad a fabricar"] * df_c["Tiempo fabricación unidad MCH"]
+        pendientes = pd.concat([resto, nuevas], ignore_index=True).sort_values(
+            ["Material","Unidad","Centro","Necesidad"], kind="stable"
         )
+        libro = liberar_capacidad(libro, inicio, calendario, capacidades)
 
-        return df_c, capacidades, DG_code, MCH_code
+        df_nuevas = modo_C(
+            pendientes[["Material","Unidad","Centro","Cantidad","Dia","Semana","Lote_min","Lote_max","Necesidad"]],
+            df_mat, capacidades, DG_code, MCH_code, capacidad_restante=libro, calendario=calendario
+        )
+        if not df_nuevas.empty:
+            df_nuevas = calcular_horas(df_nuevas, df_mat, DG_code)
+
+        df_plan = pd.concat([conservadas, df_nuevas], ignore_index=True)
+        df_plan["Nº de propuesta"] = np.arange(1, len(df_plan) + 1)
+        resumen = {
+            "centros": {str(c): texto_de_dia(d) for c, d in inicio.items()},
+            "reutilizadas": int(len(conservadas)),
+            "recalculadas": int(len(df_nuevas)),
+        }
+        return df_plan, libro, resumen
 
     # -----------------------------
     # Reajuste semanal + Replanificación
     # -----------------------------
-    def replanificar_con_porcentajes(df_base, df_mat, capacidades, DG_code, MCH_code, ajustes):
+    def replanificar_con_porcentajes(df_base, df_mat, capacidades, DG_code, MCH_code, ajustes, calendario=None):
         df_repartido = []
-        for sem in sorted(df_base["Semana"].dropna().astype(str).unique().tolist()):
-            df_sem = df_base[df_base["Semana"].astype(str) == sem].copy()
+        # Una sola pasada por semanas (categorías ordenadas) en vez de filtrar con astype(str)
+        for sem, df_sem in df_base.groupby("Semana", observed=True, sort=True):
             if df_sem.empty:
                 continue
+            df_sem = df_sem.copy()
             pct = ajustes.get(sem, 50)
             df_sem = repartir_porcentaje(df_sem, pct, DG_code, MCH_code)
             df_repartido.append(df_sem)
@@ -599,31 +2476,49 @@ with tab2:
         df_adj = pd.concat(df_repartido, ignore_index=True) if df_repartido else df_base.copy()
 
         df_adj_pre = df_adj.rename(columns={"Cantidad a fabricar":"Cantidad"})[
-            ["Material","Unidad","Centro","Cantidad","Fecha","Semana","Lote_min","Lote_max"]
+            ["Material","Unidad","Centro","Cantidad","Dia","Semana","Lote_min","Lote_max"]
         ]
-        df_final = modo_C(df_adj_pre, df_mat, capacidades, DG_code, MCH_code)
+        df_final = modo_C(df_adj_pre, df_mat, capacidades, DG_code, MCH_code, calendario=calendario)
 
         # Recalcular Horas
-        tiempos = df_mat[["Material","Unidad","Tiempo fabricación unidad DG","Tiempo fabricación unidad MCH"]].drop_duplicates()
-        df_final = df_final.merge(tiempos, on=["Material","Unidad"], how="left")
-        df_final["Horas"] = np.where(
-            df_final["Centro"].astype(str) == str(DG_code),
-            df_final["Cantidad a fabricar"] * df_final["Tiempo fabricación unidad DG"],
-            df_final["Cantidad a fabricar"] * df_final["Tiempo fabricación unidad MCH"]
-        )
-        return df_final
+        return calcular_horas(df_final, df_mat, DG_code)
 
     # -----------------------------
     # UI — Paso 1: Generación inicial
     # -----------------------------
     st.subheader("🚀 Generación inicial de la planificación")
 
-    if st.button("🚀 EJECUTAR CÁLCULO DE PROPUESTA", use_container_width=True):
+    # Validación de entradas: se repite solo si cambia algún maestro
+    datos = (df_cap, df_mat, df_cli, df_dem)
+    # Informe por celda hecho en la carga, sobre los archivos originales
+    validacion_crudas = {c: st.session_state.get("cargas", {}).get(c, {}).get("incidencias") for c in MAESTROS}
+    validacion = st.session_state.get("validacion", {})
+    if len(validacion.get("datos", ())) != 4 or any(a is not b for a, b in zip(validacion["datos"], datos)):
+        t0 = time.perf_counter()
+        informe = validar_entradas(*datos, crudas=validacion_crudas)
+        registrar_metrica("validar_entradas", segundos=round(time.perf_counter() - t0, 4),
+                          filas=sum(len(d) for d in datos), incidencias=len(informe))
+        validacion = st.session_state.validacion = {"datos": datos, "informe": informe}
+    entradas_con_errores = mostrar_validacion(validacion["informe"])
+    if st.session_state.get("origen_datos") == "carpeta":
+        st.info(f"📂 Plan precalculado con los archivos de «{ENTRADA_DIR}» ({st.session_state.plan_erp}). "
+                "Pulsa EJECUTAR solo si quieres recalcularlo.")
+
+    if st.button("🚀 EJECUTAR CÁLCULO DE PROPUESTA", use_container_width=True, disabled=entradas_con_errores):
         with st.spinner("Generando planificación inicial…"):
-            df_base, capacidades, DG, MCH = ejecutar_modoC_base(df_cap, df_mat, df_cli, df_dem)
+            try:
+                df_base, capacidades, DG, MCH, g_base, libro_base, calendario = ejecutar_modoC_base(
+                    df_cap, df_mat, df_cli, df_dem, st.session_state.get("politica_duplicados", POLITICAS_DUPLICADOS[0])
+                )
+            except ValueError as e:
+                st.error(f"❌ {e}")
+                st.stop()
 
         st.session_state.calculo_realizado = True
         st.session_state.df_base = df_base
+        st.session_state.g_base = g_base
+        st.session_state.libro_base = libro_base
+        st.session_state.calendario = calendario
         st.session_state.capacidades = capacidades
         st.session_state.DG = DG
         st.session_state.MCH = MCH
@@ -633,7 +2528,7 @@ with tab2:
         # 🔹 LOG del cálculo inicial
         try:
             horas_por_centro_ini = (
-                st.session_state.df_base.groupby("Centro")["Horas"].sum().to_dict()
+                st.session_state.df_base.groupby("Centro", observed=True)["Horas"].sum().to_dict()
                 if isinstance(st.session_state.df_base, pd.DataFrame) else {}
             )
             resumen_ini = {
@@ -646,7 +2541,7 @@ with tab2:
                 "DG": str(st.session_state.DG),
                 "MCH": str(st.session_state.MCH)
             }
-            log_event("calculo_inicial", details=detalles_ini, results=resumen_ini)
+            log_event("calculo_inicial", details=detalles_ini, results=resumen_ini, plan=df_base)
         except Exception:
             pass
 
@@ -654,40 +2549,49 @@ with tab2:
     # Utilidad: mostrar y descargar sin Semana/Lote_min/Lote_max
     # -----------------------------
     def mostrar_detalle_y_descargar(df, nombre_descarga):
-        cols_visibles = [
-            "Nº de propuesta","Material","Centro","Clase de orden",
-            "Cantidad a fabricar","Unidad","Fecha"
-        ]
-        cols_presentes = [c for c in cols_visibles if c in df.columns]
+        cols_presentes = [c for c in COLUMNAS_PROPUESTA if c in df.columns]
 
         st.dataframe(df[cols_presentes], use_container_width=True, height=420)
 
-        output_path = os.path.join(UPLOAD_DIR, f"{nombre_descarga} {datetime.now().strftime('%Y%m%d')}.xlsx")
-        try:
-            df[cols_presentes].to_excel(output_path, index=False)
-
-            # 🔹 LOG de exportación a Excel
-            try:
-                log_event(
-                    "export_excel",
-                    details={
-                        "nombre_descarga": nombre_descarga,
-                        "path": output_path,
-                        "columnas": cols_presentes
-                    },
-                    results={"rows": int(len(df[cols_presentes]))}
-                )
-            except Exception:
-                pass
+        # El archivo se genera al pulsar Descargar (no en cada rerun) y se reutiliza mientras no cambie el plan
+        formato = formato_exportacion(len(df))
+        nombre_archivo = f"{nombre_descarga} {datetime.now().strftime('%Y%m%d')}.{formato}"
+        if formato == "csv":
+            st.caption(f"Más de {EXPORT_MAX_FILAS_EXCEL:,} propuestas: se descarga en CSV (separador «;»).".replace(",", "."))
+        st.download_button(
+            f"📥 Descargar {nombre_descarga} ({'Excel' if formato == 'xlsx' else 'CSV'})",
+            data=descarga_diferida(
+                df, cols_presentes, huella_en_sesion(nombre_descarga, df, cols_presentes),
+                {"nombre_descarga": nombre_descarga, "archivo": nombre_archivo, "columnas": cols_presentes}
+            ),
+            file_name=nombre_archivo,
+            mime="text/csv" if formato == "csv" else None,
+            on_click="ignore"
+        )
 
-            with open(output_path, "rb") as f:
-                st.download_button(
-                    f"📥 Descargar {nombre_descarga} (Excel)",
-                    data=f,
-                    file_name=f"{nombre_descarga} {datetime.now().strftime('%Y%m%d')}.xlsx"
-                )
-        except Exception as e:
-            st.info(f"No se pudo generar el Excel: {e}")
+        # Carga masiva al ERP: columnas fijas, Fecha AAAAMMDD; opcionalmente en partes (zip)
+        with st.expander("🏭 Exportar para carga masiva en el ERP"):
+            filas_parte = st.number_input(
+                "Propuestas por archivo (0 = un solo archivo)", min_value=0, value=0, step=10_000,
+                key=f"erp_partes_{nombre_descarga}",
+                help="Con un valor mayor que 0 se descarga un zip con varios archivos, cada uno con su cabecera."
+            )
+            cols_erp = ERP_COLUMNAS + (["Dia"] if "Dia" in df.columns else [])
+            base_erp = f"{nombre_descarga} ERP {datetime.now().strftime('%Y%m%d')}"
+            nombre_erp = f"{base_erp}.zip" if filas_parte else f"{base_erp}.csv"
+            st.caption(f"Separador «{ERP_SEPARADOR}», decimal «{ERP_DECIMAL}», columnas: {', '.join(ERP_COLUMNAS)}.")
+            st.download_button(
+                "📥 Descargar formato ERP",
+                data=descarga_diferida(
+                    df, cols_erp, huella_en_sesion(f"{nombre_descarga} ERP", df, cols_erp),
+                    {"nombre_descarga": nombre_descarga, "archivo": nombre_erp, "columnas": ERP_COLUMNAS},
+                    formato="erp", filas_por_archivo=int(filas_parte) or None
+                ),
+                file_name=nombre_erp,
+                mime="application/zip" if filas_parte else "text/csv",
+                on_click="ignore",
+                key=f"erp_descarga_{nombre_descarga}"
+            )
 
     # -----------------------------
     # Mostrar resultados del cálculo inicial
@@ -699,7 +2603,7 @@ with tab2:
 
         # Métricas
         total_props = len(df_base)
-        horas_por_centro = df_base.groupby("Centro")["Horas"].sum().to_dict()
+        horas_por_centro = df_base.groupby("Centro", observed=True)["Horas"].sum().to_dict()
         m = st.columns(3)
         m[0].metric("Total Propuestas (inicial)", f"{total_props:,}".replace(",", "."))
         m[1].metric(f"Horas totales {DG}", f"{horas_por_centro.get(DG, 0):,.1f}h".replace(",", "."))
@@ -707,16 +2611,7 @@ with tab2:
 
         # Distribución semanal (inicial)
         st.subheader("📊 Distribución de Carga Horaria (semanal)")
-        df_base_plot = df_base.copy()
-        df_base_plot["Centro"] = df_base_plot["Centro"].astype(str)
-        df_base_plot["Semana"] = df_base_plot["Semana"].astype(str)  # asegura la 'W' como texto
-        carga_plot_ini = (
-            df_base_plot.groupby(["Semana", "Centro"])["Horas"]
-                        .sum()
-                        .unstack()
-                        .fillna(0)
-                        .sort_index()
-        )
+        carga_plot_ini = carga_semanal(df_base)
         col_order = [str(DG), str(MCH)]
         carga_plot_ini = carga_plot_ini.reindex(columns=[c for c in col_order if c in carga_plot_ini.columns])
         st.bar_chart(carga_plot_ini, use_container_width=True)
@@ -727,6 +2622,73 @@ with tab2:
         st.subheader("📋 Detalle de la Propuesta (inicial)")
         mostrar_detalle_y_descargar(df_base, "Propuesta Inicial")
 
+        # -----------------------------
+        # Actualización incremental de la demanda
+        # -----------------------------
+        st.markdown("---")
+        st.subheader("🔄 Actualización incremental de la demanda")
+        st.caption(
+            "Sube solo las líneas nuevas, modificadas o dadas de baja (columna opcional **Operación** = B "
+            "para bajas). Se replanifican únicamente los centros y fechas afectados."
+        )
+        if st.session_state.get("aviso_delta"):
+            st.success(st.session_state.pop("aviso_delta"))
+
+        f_delta = st.file_uploader("Subir cambios de demanda", type=["xlsx", "csv"], key="u_delta")
+        if f_delta is not None and st.button("Aplicar cambios y replanificar fechas afectadas", use_container_width=True):
+            try:
+                tabla_delta = leer_tabla(f_delta)
+                # Líneas del archivo de cambios revisadas tal como llegan (las bajas no necesitan cantidad)
+                informe_delta = validar_hoja("df_dem", tabla_delta[~bajas_por_operacion(tabla_delta)])
+                informe_delta["Tabla"] = "Cambios de demanda"
+                if informe_delta["Gravedad"].eq("Error").any():
+                    mostrar_validacion(informe_delta)
+                    st.stop()
+                df_dem_nueva, res_delta = aplicar_delta_demanda(df_dem, tabla_delta)
+            except Exception as e:
+                st.error(f"❌ No se pudieron aplicar los cambios: {e}")
+            else:
+                # La demanda resultante se valida entera (claves contra los maestros) antes de replanificar
+                crudas = dict(validacion_crudas)
+                if crudas.get("df_dem") is not None:
+                    crudas["df_dem"] = _informe([crudas["df_dem"], informe_delta])
+                if mostrar_validacion(validar_entradas(df_cap, df_mat, df_cli, df_dem_nueva, crudas=crudas)):
+                    st.stop()
+                with st.spinner("Replanificando fechas afectadas…"):
+                    t0 = time.perf_counter()
+                    try:
+                        g_new, _, _, _ = preparar_demanda_base(
+                            df_cap, df_mat, df_cli, df_dem_nueva,
+                            st.session_state.get("politica_duplicados", POLITICAS_DUPLICADOS[0])
+                        )
+                        df_plan, libro, res_plan = replanificar_delta(
+                            st.session_state.g_base, g_new, df_base, st.session_state.libro_base,
+                            df_mat, st.session_state.capacidades, DG, MCH,
+                            calendario=st.session_state.get("calendario")
+                        )
+                    except ValueError as e:
+                        st.error(f"❌ {e}")
+                        st.stop()
+                    seg = round(time.perf_counter() - t0, 4)
+                registrar_metrica("replanificar_delta", segundos=seg, **{k: v for k, v in res_plan.items() if k != "centros"})
+
+                st.session_state.df_dem = df_dem_nueva
+                if "df_dem" in st.session_state.get("cargas", {}):
+                    st.session_state.cargas["df_dem"]["incidencias"] = crudas.get("df_dem")
+                st.session_state.g_base = g_new
+                st.session_state.df_base = df_plan
+                st.session_state.libro_base = libro
+                st.session_state.df_final_reajuste = None
+                log_event("delta_demanda", details=res_delta, results={**res_plan, "segundos": seg})
+
+                desde = ", ".join(f"{c} desde {d}" for c, d in res_plan["centros"].items()) or "sin cambios en el plan"
+                st.session_state.aviso_delta = (
+                    f"✅ Delta aplicado: {res_delta['altas']} altas, {res_delta['cambios']} cambios, "
+                    f"{res_delta['bajas']} bajas ({desde}). Propuestas reutilizadas: {res_plan['reutilizadas']}, "
+                    f"recalculadas: {res_plan['recalculadas']} en {seg:.2f} s."
+                )
+                st.rerun()
+
         st.markdown("---")
         st.subheader("🔁 ¿Quieres reajustar por semana y re‑planificar?")
 
@@ -745,26 +2707,32 @@ with tab2:
             st.info("Pulsa **Aplicar porcentajes** para re‑planificar.")
             if st.button("Aplicar porcentajes y re‑planificar", use_container_width=True):
                 with st.spinner("Aplicando reparto y re‑planificando…"):
-                    df_final = replanificar_con_porcentajes(
-                        df_base=st.session_state.df_base,
-                        df_mat=st.session_state.df_mat,
-                        capacidades=st.session_state.capacidades,
-                        DG_code=st.session_state.DG,
-                        MCH_code=st.session_state.MCH,
-                        ajustes=ajustes
-                    )
+                    try:
+                        df_final = replanificar_con_porcentajes(
+                            df_base=st.session_state.df_base,
+                            df_mat=st.session_state.df_mat,
+                            capacidades=st.session_state.capacidades,
+                            DG_code=st.session_state.DG,
+                            MCH_code=st.session_state.MCH,
+                            ajustes=ajustes,
+                            calendario=st.session_state.get("calendario")
+                        )
+                    except ValueError as e:
+                        st.error(f"❌ {e}")
+                        st.stop()
                 st.session_state.df_final_reajuste = df_final
+                st.session_state.ajustes_reajuste = ajustes
                 st.success("✅ Re‑planificación completada.")
 
                 # 🔹 LOG de replanificación
                 try:
-                    horas_por_centro_fin = df_final.groupby("Centro")["Horas"].sum().to_dict()
+                    horas_por_centro_fin = df_final.groupby("Centro", observed=True)["Horas"].sum().to_dict()
                     resumen_fin = {
                         "total_propuestas": int(len(df_final)),
                         "horas_por_centro": {str(k): float(v) for k, v in horas_por_centro_fin.items()},
                         "semanas": sorted(df_final["Semana"].astype(str).unique().tolist())
                     }
-                    log_event("replanificacion", details={"ajustes": ajustes}, results=resumen_fin)
+                    log_event("replanificacion", details={"ajustes": ajustes}, results=resumen_fin, plan=df_final)
                 except Exception:
                     pass
 
@@ -774,23 +2742,14 @@ with tab2:
 
             st.markdown("---")
             st.subheader("📈 Resultados tras Re‑planificación")
-            horas_por_centro_final = df_final.groupby("Centro")["Horas"].sum().to_dict()
+            horas_por_centro_final = df_final.groupby("Centro", observed=True)["Horas"].sum().to_dict()
             m2 = st.columns(3)
             m2[0].metric("Total Propuestas (reajuste)", f"{len(df_final):,}".replace(",", "."))
             m2[1].metric(f"Horas totales {DG}", f"{horas_por_centro_final.get(DG, 0):,.1f}h".replace(",", "."))
             m2[2].metric(f"Horas totales {MCH}", f"{horas_por_centro_final.get(MCH, 0):,.1f}h".replace(",", "."))
 
             st.subheader("📊 Distribución de Carga Horaria (semanal) — Re‑planificación")
-            df_final_plot = df_final.copy()
-            df_final_plot["Centro"] = df_final_plot["Centro"].astype(str)
-            df_final_plot["Semana"] = df_final_plot["Semana"].astype(str)
-            carga_plot_fin = (
-                df_final_plot.groupby(["Semana", "Centro"])["Horas"]
-                             .sum()
-                             .unstack()
-                             .fillna(0)
-                             .sort_index()
-            )
+            carga_plot_fin = carga_semanal(df_final)
             col_order = [str(DG), str(MCH)]
             carga_plot_fin = carga_plot_fin.reindex(columns=[c for c in col_order if c in carga_plot_fin.columns])
             st.bar_chart(carga_plot_fin, use_container_width=True)
@@ -800,60 +2759,54 @@ with tab2:
             st.subheader("📋 Detalle de la Propuesta (reajustada)")
             mostrar_detalle_y_descargar(df_final, "Propuesta Replan")
 
-# =========================
-# TAB 3 — HISTORIAL
-# =========================
-with tab3:
-    st.subheader("🧾 Historial de acciones")
-    try:
-        with _get_conn() as conn:
-            df_logs = pd.read_sql_query(
-                "SELECT id, ts, user, action, session_id, payload, result FROM logs ORDER BY id DESC LIMIT 1000",
-                conn
-            )
-        # Filtros
-        colf1, colf2, colf3 = st.columns([1,1,2])
-        with colf1:
-            usuarios = ["(todos)"] + sorted([u for u in df_logs["user"].dropna().unique().tolist()])
-            f_user = st.selectbox("Usuario", usuarios, index=0)
-        with colf2:
-            acciones = ["(todas)"] + sorted([a for a in df_logs["action"].dropna().unique().tolist()])
-            f_action = st.selectbox("Acción", acciones, index=0)
-        with colf3:
-            st.caption("Consejo: usa la lupa del Dataframe para buscar por `session_id` y agrupar acciones de una sesión.")
-
-        if f_user != "(todos)":
-            df_logs = df_logs[df_logs["user"] == f_user]
-        if f_action != "(todas)":
-            df_logs = df_logs[df_logs["action"] == f_action]
-
-        st.dataframe(df_logs, use_container_width=True, height=420)
-
-        # Exportar historial filtrado a CSV
-        csv_bytes = df_logs.to_csv(index=False).encode("utf-8")
+        # Paquete único: propuestas, cargas semanales y ajustes en un zip
+        st.markdown("---")
+        df_final_paq = st.session_state.get("df_final_reajuste")
         st.download_button(
-            "📥 Descargar historial (CSV)",
-            data=csv_bytes,
-            file_name=f"historial_{datetime.now().strftime('%Y%m%d_%H%M%S')}.csv",
-            mime="text/csv"
+            "📦 Descargar paquete completo (zip)",
+            data=descarga_paquete(
+                st.session_state.df_base, df_final_paq, st.session_state.get("ajustes_reajuste"),
+                DG, MCH
+            ),
+            file_name=f"Paquete planificación {datetime.now().strftime('%Y%m%d')}.zip",
+            mime="application/zip",
+            on_click="ignore",
+            use_container_width=True,
+            help="Propuesta inicial" + (", propuesta reajustada" if df_final_paq is not None else "")
+                 + ", carga semanal por centro y ajustes usados."
         )
 
-        # Mantenimiento opcional: borrar logs antiguos
-        with st.expander("🧹 Mantenimiento (opcional)"):
-            dias = st.slider("Borrar logs anteriores a (días)", 30, 365, 90)
-            if st.button("Borrar logs antiguos"):
-                try:
-                    limite = (datetime.now() - timedelta(days=dias)).isoformat()
-                    with _get_conn() as conn:
-                        c = conn.cursor()
-                        c.execute("DELETE FROM logs WHERE ts < ?", (limite,))
-                        conn.commit()
-                    st.success("Hecho. Recarga para ver el resultado.")
-                except Exception as e:
-                    st.error(f"No se pudieron borrar logs: {e}")
+    # -----------------------------
+    # Rendimiento: tiempos por etapa y memoria de la sesión
+    # -----------------------------
+    st.markdown("---")
+    with st.expander("⏱ Rendimiento"):
+        metricas = st.session_state.get("metricas", [])
+        if metricas:
+            st.dataframe(pd.DataFrame(metricas), use_container_width=True)
+        else:
+            st.caption("Aún no hay medidas: ejecuta el cálculo.")
 
-    except Exception as e:
-        st.info(f"No se pudo cargar el historial: {e}")
+        if st.checkbox("Medir memoria de la sesión", key="medir_memoria"):
+            mem = memoria_sesion()
+            st.dataframe(mem.style.format({"MB": "{:,.2f}", "MB claves texto": "{:,.2f}"}), use_container_width=True)
+            st.caption(
+                f"Total: {mem['MB'].sum():,.2f} MB · con claves como texto: {mem['MB claves texto'].sum():,.2f} MB"
+            )
+
+        if st.button("Comparar agrupación de la demanda (texto vs. códigos)"):
+            col_cli_cmp = detectar_columna_cliente(df_dem)
+            claves_cmp = [c for c in ["Material", "Unidad", col_cli_cmp, "Fecha de necesidad"] if c in df_dem.columns]
+            tiempos_cmp = {}
+            for nombre_cmp, df_cmp in [
+                ("texto", df_dem.astype({c: object for c in claves_cmp if c != "Fecha de necesidad"})),
+                ("códigos", df_dem),
+            ]:
+                t0 = time.perf_counter()
+                df_cmp.groupby(claves_cmp, dropna=False, observed=True)["Cantidad"].sum()
+                tiempos_cmp[nombre_cmp] = time.perf_counter() - t0
+            registrar_metrica("agrupar_comparativa", filas=len(df_dem), **{f"s_{k}": round(v, 4) for k, v in tiempos_cmp.items()})
+            st.write({k: f"{v * 1000:,.1f} ms" for k, v in tiempos_cmp.items()})
 
 # Footer — Versión 3
 st.markdown("---")
@@ -7,6 +7,9 @@ import streamlit as st
 import pandas as pd
 import numpy as np
 import os
+import csv
+import json
+import hashlib
 from datetime import datetime, timedelta
 
 # ------------------------------------------------------------
@@ -29,39 +32,116 @@ os.makedirs(UPLOAD_DIR, exist_ok=True)
 # HISTORIAL SIMPLE (solo 'calculo_inicial' y 'replanificacion')
 # ------------------------------------------------------------
 LOG_MINI = os.path.join(UPLOAD_DIR, "historial_min.csv")
+LOG_MINI_ESTADO = os.path.join(UPLOAD_DIR, "historial_min_estado.json")   # últimos ts por acción
+LOG_MINI_MAX_BYTES = 1_000_000   # al superarlo se rota: historial_min.1.csv, .2.csv, …
+LOG_MINI_ROTADOS = 5
+
+def _rotar_log_mini():
+    """historial_min.csv → .1.csv, .1 → .2, …; el más antiguo se descarta."""
+    base, ext = os.path.splitext(LOG_MINI)
+    for i in range(LOG_MINI_ROTADOS - 1, 0, -1):
+        if os.path.exists(f"{base}.{i}{ext}"):
+            os.replace(f"{base}.{i}{ext}", f"{base}.{i + 1}{ext}")
+    os.replace(LOG_MINI, f"{base}.1{ext}")
+
+def _guardar_estado_mini(estado):
+    tmp = LOG_MINI_ESTADO + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(estado, f)
+    os.replace(tmp, LOG_MINI_ESTADO)
 
 def log_mini(action):
-    """Registra un evento mínimo en CSV."""
-    row = {
-        "ts": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-        "action": action
-    }
-    if os.path.exists(LOG_MINI):
-        df = pd.read_csv(LOG_MINI)
-        df = pd.concat([df, pd.DataFrame([row])], ignore_index=True)
-    else:
-        df = pd.DataFrame([row])
-    df.to_csv(LOG_MINI, index=False)
+    """Registra un evento mínimo en CSV (solo se añade una línea; el archivo rota por tamaño)."""
+    ts = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    if os.path.exists(LOG_MINI) and os.path.getsize(LOG_MINI) >= LOG_MINI_MAX_BYTES:
+        _rotar_log_mini()
+    with open(LOG_MINI, "a", newline="", encoding="utf-8") as f:
+        w = csv.writer(f, lineterminator="\n")
+        if f.tell() == 0:
+            w.writerow(["ts", "action"])
+        w.writerow([ts, action])
+    estado = _leer_estado_mini()
+    estado[action] = ts
+    _guardar_estado_mini(estado)
+
+def _leer_estado_mini():
+    try:
+        with open(LOG_MINI_ESTADO, encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        pass
+    # Sin archivo de estado (historial anterior a la rotación): se reconstruye una vez
+    estado = {}
+    base, ext = os.path.splitext(LOG_MINI)
+    for ruta in [f"{base}.{i}{ext}" for i in range(LOG_MINI_ROTADOS, 0, -1)] + [LOG_MINI]:
+        if os.path.exists(ruta):
+            df = pd.read_csv(ruta)
+            if not df.empty:
+                estado.update(df.groupby("action")["ts"].max().to_dict())
+    _guardar_estado_mini(estado)   # también vacío: no se vuelven a buscar los CSV en cada llamada
+    return estado
 
 def last_status():
     """Devuelve últimos timestamps de cálculo inicial y replanificación."""
-    if not os.path.exists(LOG_MINI):
-        return None, None
-    df = pd.read_csv(LOG_MINI)
-    t_calc = df[df["action"] == "calculo_inicial"]["ts"].max() if not df.empty else None
-    t_repl = df[df["action"] == "replanificacion"]["ts"].max() if not df.empty else None
-    return t_calc, t_repl
+    estado = _leer_estado_mini()
+    return estado.get("calculo_inicial"), estado.get("replanificacion")
+
+# ------------------------------------------------------------
+# MANIFIESTO DE PROPUESTAS GENERADAS
+# ------------------------------------------------------------
+# UPLOAD_DIR también guarda todas las copias de las subidas; en lugar de
+# recorrerlo en cada rerun, cada Excel generado se anota al escribirlo.
+MANIFIESTO_GENERADOS = os.path.join(UPLOAD_DIR, "generados.json")
+
+def huella_df(df):
+    """Huella del contenido (filas y nombres de columna) de un DataFrame."""
+    h = hashlib.blake2b(digest_size=16)
+    h.update("|".join(map(str, df.columns)).encode("utf-8"))
+    h.update(pd.util.hash_pandas_object(df, index=False).to_numpy().tobytes())
+    return f"{len(df)}-{h.hexdigest()}"
+
+def _guardar_manifiesto(manifiesto):
+    tmp = MANIFIESTO_GENERADOS + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(manifiesto, f, ensure_ascii=False)
+    os.replace(tmp, MANIFIESTO_GENERADOS)
+
+def leer_manifiesto():
+    """{ruta: {ruta, tipo, bytes, mtime, huella}} de las propuestas generadas."""
+    try:
+        with open(MANIFIESTO_GENERADOS, encoding="utf-8") as f:
+            manifiesto = json.load(f)
+    except (OSError, ValueError):
+        pass
+    else:
+        # Archivos borrados o movidos fuera de la app: se quitan del manifiesto
+        vigentes = {r: e for r, e in manifiesto.items() if os.path.exists(r)}
+        if len(vigentes) != len(manifiesto):
+            _guardar_manifiesto(vigentes)
+        return vigentes
+    # Sin manifiesto (archivos anteriores a él): se reconstruye una vez del directorio
+    manifiesto = {}
+    for fn in os.listdir(UPLOAD_DIR):
+        if fn.endswith(".xlsx") and (fn.startswith("Propuesta Inicial") or fn.startswith("Propuesta Replan")):
+            ruta = os.path.join(UPLOAD_DIR, fn)
+            info = os.stat(ruta)
+            tipo = "Propuesta Inicial" if fn.startswith("Propuesta Inicial") else "Propuesta Replan"
+            manifiesto[ruta] = {"ruta": ruta, "tipo": tipo, "bytes": info.st_size,
+                                "mtime": info.st_mtime, "huella": None}
+    _guardar_manifiesto(manifiesto)   # también vacío: no se vuelve a recorrer el directorio
+    return manifiesto
+
+def registrar_generado(ruta, tipo, huella):
+    """Anota (o actualiza) un archivo recién escrito en el manifiesto."""
+    info = os.stat(ruta)
+    manifiesto = leer_manifiesto()
+    manifiesto[ruta] = {"ruta": ruta, "tipo": tipo, "bytes": info.st_size,
+                        "mtime": info.st_mtime, "huella": huella}
+    _guardar_manifiesto(manifiesto)
 
 def list_generated_files():
-    """Lista archivos Excel generados por la app (Propuestas)."""
-    files = set(st.session_state.get("archivos_generados", []))
-    if os.path.isdir(UPLOAD_DIR):
-        for fn in os.listdir(UPLOAD_DIR):
-            if fn.endswith(".xlsx") and (fn.startswith("Propuesta Inicial") or fn.startswith("Propuesta Replan")):
-                files.add(os.path.join(UPLOAD_DIR, fn))
-    files = [p for p in files if os.path.exists(p)]
-    files.sort(key=lambda p: os.path.getmtime(p), reverse=True)
-    return files
+    """Propuestas generadas por la app, de la más reciente a la más antigua (lee solo el manifiesto)."""
+    return sorted(leer_manifiesto().values(), key=lambda e: e["mtime"], reverse=True)
 
 # ------------------------------------------------------------
 # ESTILOS CSS
@@ -555,13 +635,12 @@ with tab2:
 
         output_path = os.path.join(UPLOAD_DIR, f"{nombre_descarga} {datetime.now().strftime('%Y%m%d')}.xlsx")
         try:
-            df[cols_presentes].to_excel(output_path, index=False)
-
-            # Registrar archivo generado para listarlo en Historial
-            if "archivos_generados" not in st.session_state:
-                st.session_state["archivos_generados"] = []
-            if output_path not in st.session_state["archivos_generados"]:
-                st.session_state["archivos_generados"].append(output_path)
+            # Solo se reescribe el Excel si el plan cambió desde la última vez (huella del manifiesto)
+            huella = huella_df(df[cols_presentes])
+            previo = leer_manifiesto().get(output_path)
+            if previo is None or previo["huella"] != huella or not os.path.exists(output_path):
+                df[cols_presentes].to_excel(output_path, index=False)
+                registrar_generado(output_path, nombre_descarga, huella)
 
             with open(output_path, "rb") as f:
                 st.download_button(
@@ -692,7 +771,8 @@ with tab3:
     if not archivos:
         st.info("No se ha generado ningún archivo todavía.")
     else:
-        for path in archivos:
+        for entrada in archivos:
+            path = entrada["ruta"]
             name = os.path.basename(path)
             try:
                 with open(path, "rb") as f:
@@ -700,7 +780,7 @@ with tab3:
                         f"📥 Descargar {name}",
                         data=f,
                         file_name=name,
-                        key=f"dl_{name}_{int(os.path.getmtime(path))}"
+                        key=f"dl_{name}_{int(entrada['mtime'])}"
                     )
             except Exception as e:
                 st.warning(f"No se pudo abrir {name}: {e}")
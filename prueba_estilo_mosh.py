@@ -2,6 +2,7 @@ def pagina_ordenes_fabricacion():
     """
     Pantalla: 🏭 Planificación de Órdenes de Fabricación
     - Validaciones robustas (evita evaluar DataFrames en booleano).
+    - Informe de validación por fila (validar_entradas); con errores no se planifica.
     - Preparación de demanda con semana ISO y unión con materiales y clientes.
     - Selección de centro base (DG/MCH) por coste si está disponible.
     """
@@ -30,12 +31,11 @@ def pagina_ordenes_fabricacion():
     df_dem = st.session_state.df_dem
 
     # ─────────────────────────────────────────────────────────────────────
-    # Validaciones mínimas de columnas en Demanda
+    # Validación de entradas (columnas, tipos, negativos, tiempos, lotes y
+    # claves desconocidas en todas las tablas) antes de planificar
     # ─────────────────────────────────────────────────────────────────────
-    required_cols_dem = {"Material", "Unidad", "Fecha de necesidad", "Cantidad"}
-    faltan_dem = required_cols_dem - set(df_dem.columns)
-    if faltan_dem:
-        st.error("Faltan columnas en Demanda: " + ", ".join(sorted(faltan_dem)))
+    informe = validar_entradas(df_cap, df_mat, df_cli, df_dem)
+    if mostrar_validacion(informe):
         return
 
     # Semana ISO en Demanda
@@ -150,12 +150,16 @@ def pagina_ordenes_fabricacion():
         st.markdown("#### 📝 Detalle")
         st.dataframe(df_base)
 
-        # Exportación XLSX de propuesta inicial
-        path_ini = os.path.join(UPLOAD_DIR, f"Propuesta_Inicial_{datetime.now().strftime('%Y%m%d')}.xlsx")
-        df_base.to_excel(path_ini, index=False)
+        # Exportación XLSX de propuesta inicial (se genera al pulsar; caché por huella del plan)
+        cols_ini = list(df_base.columns)
         with st.expander("📥 Descargar Excel"):
-            with open(path_ini, "rb") as f:
-                st.download_button("Descargar Propuesta Inicial", f, file_name="Propuesta_Inicial.xlsx")
+            st.download_button(
+                "Descargar Propuesta Inicial",
+                descarga_diferida(df_base, cols_ini, huella_en_sesion("Propuesta_Inicial", df_base, cols_ini),
+                                  {"nombre_descarga": "Propuesta_Inicial", "columnas": cols_ini}),
+                file_name=f"Propuesta_Inicial.{formato_exportacion(len(df_base))}",
+                on_click="ignore"
+            )
                 # ─────────────────────────────────────────────────────────────────
         # Replanificación por semana (slider 0% → 100%)
         # ─────────────────────────────────────────────────────────────────
@@ -210,9 +214,13 @@ def pagina_ordenes_fabricacion():
         st.markdown("#### 📝 Detalle final")
         st.dataframe(df_final)
 
-        # Exportación XLSX de propuesta replanificada
-        path_fin = os.path.join(UPLOAD_DIR, f"Propuesta_Replanificada_{datetime.now().strftime('%Y%m%d')}.xlsx")
-        df_final.to_excel(path_fin, index=False)
+        # Exportación XLSX de propuesta replanificada (se genera al pulsar; caché por huella del plan)
+        cols_fin = list(df_final.columns)
         with st.expander("📥 Descargar Excel"):
-            with open(path_fin, "rb") as f:
-                st.download_button("Descargar Propuesta Replanificada", f, file_name="Propuesta_Replanificada.xlsx")
+            st.download_button(
+                "Descargar Propuesta Replanificada",
+                descarga_diferida(df_final, cols_fin, huella_en_sesion("Propuesta_Replanificada", df_final, cols_fin),
+                                  {"nombre_descarga": "Propuesta_Replanificada", "columnas": cols_fin}),
+                file_name=f"Propuesta_Replanificada.{formato_exportacion(len(df_final))}",
+                on_click="ignore"
+            )